@@ -0,0 +1,4670 @@
+"""agent-status — show running Claude/Codex sessions across Ghostty tabs.
+
+The agent-status launcher imports this module, so Python caches its
+bytecode instead of compiling it on every run.
+"""
+
+# Status bars and shell prompts run this thousands of times a day, so only
+# modules every invocation needs are imported here. Heavier ones (asyncio,
+# subprocess, json, socket, http...) are imported by the functions that use
+# them; test_agent_status.TestStartupImports guards the one-shot path.
+import contextlib
+import fcntl
+import functools
+import os
+import re
+import select
+import struct
+import sys
+import threading
+import time
+
+
+SESSION_COMMANDS = {"claude", "codex"}
+DEFAULT_CPU_THRESHOLD = 5.0
+CPU_THRESHOLD_ENV_VAR = "AGENT_STATUS_CPU_THRESHOLD"
+LEGACY_CPU_THRESHOLD_ENV_VAR = "CLAUDE_STATUS_CPU_THRESHOLD"
+JSON_V2_SCHEMA_VERSION = 1
+GHOSTTY_SURFACE_RE = re.compile(r"(?:^|\s)GHOSTTY_SURFACE_ID=([^\s]+)")
+ALERT_STATUSES = {"active", "idle", "stopped"}
+ALL_TRANSITIONS = [
+    (before, after) for before in sorted(ALERT_STATUSES)
+    for after in sorted(ALERT_STATUSES) if before != after
+]
+DEFAULT_ALERT_ON = [("active", "idle")]
+ALERT_DESKTOP_CHOICES = ("auto", "osascript", "notify-send", "none")
+DEFAULT_ALERT_COALESCE = 1.0
+ALERT_DELIVERY_TIMEOUT = 5
+REGISTRY_ENV_VAR = "AGENT_STATUS_REGISTRY"
+DEFAULT_REGISTRY_PATH = os.path.expanduser("~/.agent-status/registrations.jsonl")
+REGISTRY_LOCK_SUFFIX = ".lock"
+DEFAULT_REGISTRY_MAX_BYTES = 1024 * 1024
+PROC_ROOT = "/proc"
+COLLECTOR_CHOICES = ("auto", "proc", "ps")
+NO_TTY_VALUES = {"??", "?", ""}
+SOCKET_ENV_VAR = "AGENT_STATUS_SOCKET"
+DEFAULT_SOCKET_PATH = os.path.expanduser("~/.agent-status/agent-status.sock")
+DAEMON_CONNECT_TIMEOUT = 1.0
+# --aggregate: reconnect delays double from the first to the max; a one-shot
+# run waits this long for every collector's first snapshot
+AGGREGATE_BACKOFF_INITIAL = 1.0
+AGGREGATE_BACKOFF_MAX = 30.0
+AGGREGATE_READY_TIMEOUT = 2.0
+CACHE_ENV_VAR = "AGENT_STATUS_CACHE"
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.agent-status/cache")
+DISK_CACHE_VERSION = 1
+HISTORY_ENV_VAR = "AGENT_STATUS_HISTORY"
+DEFAULT_HISTORY_PATH = os.path.expanduser("~/.agent-status/history")
+# History file: a fixed header, then HISTORY_CAPACITY fixed-width records
+# reused oldest-first, so the file never grows once created
+HISTORY_MAGIC = b"AGSTHIS1"
+HISTORY_HEADER = struct.Struct("<8sIIQ")  # magic, record size, capacity, records written
+HISTORY_RECORD = struct.Struct("<IqdfB")  # pid, start (epoch secs), timestamp, cpu %, status
+HISTORY_CAPACITY = 1 << 17
+HISTORY_STATUS_CODES = {"active": 1, "idle": 2, "stopped": 3}
+# A session is sampled when its status changes, or at most this often otherwise
+HISTORY_SAMPLE_SECONDS = 10.0
+# Start times derived from etime drift by a second between cycles
+HISTORY_START_SLACK = 2
+SPARKLINE_WIDTH = 12
+SPARKLINE_BLOCKS = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+# Sparklines scale to the busiest sample, but never below this %CPU
+SPARKLINE_MIN_SCALE = 25.0
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CYCLE_BUDGET = 5.0
+GIT_TIMEOUT = 2.0
+SESSION_FIELDS = (
+    "pid", "project", "cwd", "branch", "status", "cpu", "tty", "surface_id",
+    "uptime_seconds", "uptime", "task", "registered_at",
+)
+# Fields that need a lookup beyond the process table scan
+CWD_FIELDS = {"project", "cwd", "branch"}
+REGISTRY_FIELDS = {"task", "registered_at"}
+# What format_table shows, and what alerts and the history need in any output mode
+TABLE_FIELDS = ("project", "branch", "status", "uptime", "task", "surface_id", "tty")
+ALERT_FIELDS = ("project", "status")
+HISTORY_FIELDS = ("status", "cpu", "uptime_seconds")
+METRICS_FIELDS = ("project", "branch", "status", "cpu")
+# How far a cc registration's started_at may be from the process start time
+REGISTRATION_START_SLACK = 5.0
+# With --subtree-io, an otherwise idle session whose subtree moves this many
+# bytes/s to or from storage counts as active
+DEFAULT_IO_THRESHOLD = 1024 * 1024
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (seconds) of the collection stage latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Share of the cycle budget each subprocess stage may use before it is cut off
+STAGE_BUDGET_SHARES = {"scan": 0.4, "cwds": 0.3, "surface_ids": 0.3}
+
+
+def bounded_number(convert, value, minimum, inclusive):
+    """Convert an argparse value, rejecting anything below (or at) minimum."""
+    parsed = convert(value)
+    if parsed < minimum or (parsed == minimum and not inclusive):
+        import argparse
+        raise argparse.ArgumentTypeError(f"must be {'>=' if inclusive else '>'} {minimum}")
+    return parsed
+
+
+def positive_float(value):
+    """argparse type that accepts only values > 0."""
+    return bounded_number(float, value, 0, inclusive=False)
+
+
+def non_negative_float(value):
+    """argparse type that accepts only values >= 0."""
+    return bounded_number(float, value, 0, inclusive=True)
+
+
+def non_negative_int(value):
+    """argparse type that accepts only integer values >= 0."""
+    return bounded_number(int, value, 0, inclusive=True)
+
+
+def positive_int(value):
+    """argparse type that accepts only integer values > 0."""
+    return bounded_number(int, value, 0, inclusive=False)
+
+
+def parse_alert_on(raw_values):
+    """Parse alert transition specifiers like 'active->idle,active->stopped'."""
+    if not raw_values:
+        return list(DEFAULT_ALERT_ON)
+
+    transitions = []
+    seen = set()
+    for raw in raw_values:
+        if raw is None:
+            continue
+        for chunk in raw.split(","):
+            chunk = chunk.strip()
+            if not chunk:
+                continue
+            if "->" not in chunk:
+                raise ValueError(
+                    f"invalid transition '{chunk}'; expected format 'from->to'"
+                )
+            parts = chunk.split("->")
+            if len(parts) != 2:
+                raise ValueError(
+                    f"invalid transition '{chunk}'; expected format 'from->to'"
+                )
+            from_status = parts[0].strip()
+            to_status = parts[1].strip()
+            if from_status not in ALERT_STATUSES or to_status not in ALERT_STATUSES:
+                raise ValueError(
+                    f"invalid transition '{chunk}'; valid statuses: "
+                    f"{', '.join(sorted(ALERT_STATUSES))}"
+                )
+            key = (from_status, to_status)
+            if key not in seen:
+                transitions.append(key)
+                seen.add(key)
+
+    if not transitions:
+        return list(DEFAULT_ALERT_ON)
+
+    return transitions
+
+
+def parse_fields(raw):
+    """Parse a --fields list like 'pid,status'. Returns a tuple, or None when raw is None."""
+    if raw is None:
+        return None
+    fields = []
+    for chunk in raw.split(","):
+        name = chunk.strip()
+        if not name:
+            continue
+        if name not in SESSION_FIELDS:
+            raise ValueError(
+                f"unknown field '{name}'; valid fields: {', '.join(SESSION_FIELDS)}"
+            )
+        if name not in fields:
+            fields.append(name)
+    if not fields:
+        raise ValueError("--fields needs at least one field name")
+    return tuple(fields)
+
+
+def resolve_fields(args):
+    """Return (fields to collect, fields to print) for args; None means all of them.
+
+    The table only collects the columns it shows; --fields narrows JSON
+    output, plus whatever --alert, the activity history and metrics need.
+    """
+    extra = ()
+    if args.alert:
+        extra += ALERT_FIELDS
+    if history_enabled(args) or args.sparkline:
+        extra += HISTORY_FIELDS
+    if args.metrics_port is not None or args.metrics_textfile:
+        extra += METRICS_FIELDS
+    if not (args.json_output or args.json_v2 or args.json_diff):
+        hidden = set() if not args.no_task else {"task"}
+        shown = tuple(name for name in TABLE_FIELDS if name not in hidden)
+        return shown + tuple(dict.fromkeys(n for n in extra if n not in shown)), None
+    if args.fields is None:
+        return None, None
+    extra = tuple(dict.fromkeys(name for name in extra if name not in args.fields))
+    return args.fields + extra, args.fields
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Show running Claude/Codex sessions",
+    )
+    parser.add_argument(
+        "--watch", action="store_true", help="re-print continuously"
+    )
+    parser.add_argument(
+        "--interval", type=positive_float, default=2.0, metavar="SECS",
+        help="refresh interval for --watch in seconds (default: 2)",
+    )
+    parser.add_argument(
+        "--interval-active", type=positive_float, default=None, metavar="SECS",
+        help="watch interval while any session is active (defaults to --interval)",
+    )
+    parser.add_argument(
+        "--interval-idle", type=positive_float, default=None, metavar="SECS",
+        help="watch interval when no sessions are active (defaults to --interval)",
+    )
+    parser.add_argument(
+        "--json", action="store_true", dest="json_output", help="output as JSON"
+    )
+    parser.add_argument(
+        "--json-v2", action="store_true",
+        help="output JSON envelope with metadata",
+    )
+    parser.add_argument(
+        "--json-diff", action="store_true",
+        help=(
+            "output compact NDJSON events: a full snapshot, then added/removed/changed "
+            "sessions as they happen (use with --watch)"
+        ),
+    )
+    parser.add_argument(
+        "--fields", metavar="NAMES",
+        help=(
+            "comma-separated session fields for JSON output, e.g. 'pid,status'; lookups "
+            f"for other fields are skipped (fields: {', '.join(SESSION_FIELDS)})"
+        ),
+    )
+    parser.add_argument(
+        "--alert", action="store_true",
+        help="notify when a session goes from active to idle (use with --watch)",
+    )
+    parser.add_argument(
+        "--alert-on",
+        action="append",
+        metavar="TRANSITIONS",
+        help=(
+            "comma-separated transitions to alert on, e.g. 'active->idle,active->stopped' "
+            "(default: active->idle)"
+        ),
+    )
+    parser.add_argument(
+        "--alert-cooldown",
+        type=non_negative_float,
+        default=0.0,
+        metavar="SECS",
+        help="minimum seconds between alerts for the same session/transition (default: 0)",
+    )
+    parser.add_argument(
+        "--alert-desktop",
+        choices=ALERT_DESKTOP_CHOICES,
+        default="auto",
+        help="desktop notification backend (default: auto, osascript on macOS, notify-send elsewhere)",
+    )
+    parser.add_argument(
+        "--alert-command",
+        metavar="CMD",
+        help="also run CMD (via the shell) per notification, with the notification JSON on stdin",
+    )
+    parser.add_argument(
+        "--alert-webhook",
+        metavar="URL",
+        help="also POST the notification JSON to URL (http://... or unix:/path/to.sock)",
+    )
+    parser.add_argument(
+        "--alert-coalesce",
+        type=non_negative_float,
+        default=DEFAULT_ALERT_COALESCE,
+        metavar="SECS",
+        help=(
+            "merge alerts arriving within SECS into one summary notification "
+            f"(default: {DEFAULT_ALERT_COALESCE:g})"
+        ),
+    )
+    parser.add_argument(
+        "--no-task",
+        action="store_true",
+        help="omit registered task column from table output",
+    )
+    parser.add_argument(
+        "--task-width",
+        type=positive_int,
+        default=24,
+        metavar="CHARS",
+        help="maximum width for task column in table output (default: 24)",
+    )
+    parser.add_argument(
+        "--goto", metavar="PROJECT",
+        help="focus the Ghostty tab running a session matching PROJECT",
+    )
+    parser.add_argument(
+        "--cpu-threshold",
+        type=non_negative_float,
+        metavar="PERCENT",
+        default=None,
+        help=(
+            "CPU percentage threshold for active sessions "
+            "(default: 5.0, or AGENT_STATUS_CPU_THRESHOLD)"
+        ),
+    )
+    parser.add_argument(
+        "--subtree-cpu",
+        action="store_true",
+        help=(
+            "count the CPU of each session's child processes (builds, test runners, "
+            "tools) toward its status"
+        ),
+    )
+    parser.add_argument(
+        "--subtree-io",
+        action="store_true",
+        help=(
+            "with --watch/--serve on Linux, also treat sessions whose process subtree "
+            f"does at least {DEFAULT_IO_THRESHOLD // (1024 * 1024)} MiB/s of disk I/O as active"
+        ),
+    )
+    parser.add_argument(
+        "--registry-compact",
+        action="store_true",
+        help="compact the registry file and exit",
+    )
+    parser.add_argument(
+        "--registry-keep",
+        type=positive_int,
+        default=1000,
+        metavar="COUNT",
+        help="number of recent registry entries to keep when compacting (default: 1000)",
+    )
+    parser.add_argument(
+        "--registry-path",
+        metavar="PATH",
+        help="override registry path for --registry-compact and --registry-max-bytes",
+    )
+    parser.add_argument(
+        "--registry-prune-dead",
+        action="store_true",
+        help="also drop entries for PIDs that are no longer running when compacting",
+    )
+    parser.add_argument(
+        "--registry-max-bytes",
+        type=non_negative_int,
+        default=DEFAULT_REGISTRY_MAX_BYTES,
+        metavar="BYTES",
+        help=(
+            "compact the registry automatically once it exceeds BYTES "
+            f"(default: {DEFAULT_REGISTRY_MAX_BYTES}, 0 disables)"
+        ),
+    )
+    parser.add_argument(
+        "--collector",
+        choices=COLLECTOR_CHOICES,
+        default="auto",
+        help="process data backend: /proc on Linux, ps/lsof elsewhere (default: auto)",
+    )
+    parser.add_argument(
+        "--events", action="store_true",
+        help=(
+            "with --watch/--serve, refresh as soon as a session exits or the registry "
+            "changes; the interval becomes a fallback poll for new sessions"
+        ),
+    )
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="run a daemon that collects continuously and serves snapshots over a Unix socket",
+    )
+    parser.add_argument(
+        "--socket", metavar="PATH", default=None,
+        help=f"daemon socket path (default: {DEFAULT_SOCKET_PATH}, or {SOCKET_ENV_VAR})",
+    )
+    parser.add_argument(
+        "--listen", metavar="HOST:PORT", default=None,
+        help="with --serve, also serve over TCP for --aggregate on other hosts",
+    )
+    parser.add_argument(
+        "--aggregate", action="append", metavar="ENDPOINT",
+        help=(
+            "merge sessions from an --serve collector into one table with a host column; "
+            "repeat per host. ENDPOINT is [NAME=]HOST:PORT, [NAME=]unix:PATH or "
+            "NAME=exec:COMMAND printing a --watch --json-diff stream"
+        ),
+    )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="always collect directly, even if an --serve daemon is running",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help=(
+            "do not read or write the on-disk cwd/surface/branch cache used by "
+            f"one-shot runs with the ps collector (default path: {DEFAULT_CACHE_PATH}, "
+            f"or {CACHE_ENV_VAR})"
+        ),
+    )
+    parser.add_argument(
+        "--history", action="store_true",
+        help="print the recorded activity of recent sessions and exit",
+    )
+    parser.add_argument(
+        "--no-history", action="store_true",
+        help=(
+            "do not record activity samples in --watch/--serve "
+            f"(default path: {DEFAULT_HISTORY_PATH}, or {HISTORY_ENV_VAR})"
+        ),
+    )
+    parser.add_argument(
+        "--sparkline", action="store_true",
+        help="add a column of recent CPU activity from the history to table output",
+    )
+    parser.add_argument(
+        "--metrics-port", type=non_negative_int, default=None, metavar="PORT",
+        help="with --watch/--serve, serve Prometheus metrics on http://HOST:PORT/metrics",
+    )
+    parser.add_argument(
+        "--metrics-host", default="127.0.0.1", metavar="HOST",
+        help="address for --metrics-port to listen on (default: 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--metrics-textfile", metavar="PATH",
+        help=(
+            "with --watch/--serve, rewrite PATH with Prometheus metrics every cycle "
+            "(for node_exporter's textfile collector)"
+        ),
+    )
+    parser.add_argument(
+        "--concurrency", type=positive_int, default=DEFAULT_CONCURRENCY, metavar="COUNT",
+        help=(
+            "maximum lookups (and subprocesses) in flight at once in --watch/--serve "
+            f"(default: {DEFAULT_CONCURRENCY})"
+        ),
+    )
+    parser.add_argument(
+        "--deadline", type=positive_float, default=None, metavar="SECS",
+        help=(
+            "time budget for one collection cycle; slow lookups are retried next cycle "
+            f"(default: the watch interval, or {DEFAULT_CYCLE_BUDGET:g}s)"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time each collection stage and count subprocesses spawned",
+    )
+    args = parser.parse_args()
+    try:
+        args.alert_on = parse_alert_on(args.alert_on)
+        args.fields = parse_fields(args.fields)
+        args.aggregate = parse_endpoints(args.aggregate)
+        args.listen = parse_listen_address(args.listen)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.fields and not (args.json_output or args.json_v2 or args.json_diff):
+        parser.error("--fields requires --json, --json-v2 or --json-diff")
+    if (args.metrics_port is not None or args.metrics_textfile) and not (args.watch or args.serve):
+        parser.error("--metrics-port and --metrics-textfile require --watch or --serve")
+    if args.listen and not args.serve:
+        parser.error("--listen requires --serve")
+    if args.aggregate and (args.serve or args.goto):
+        parser.error("--aggregate cannot be combined with --serve or --goto")
+    return args
+
+
+class SpawnCounter:
+    """Thread-safe count of subprocesses started through run_command."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+
+SPAWN_COUNTER = SpawnCounter()
+
+
+def run_command(argv, **kwargs):
+    """subprocess.run wrapper that counts spawns for --profile."""
+    import subprocess
+    SPAWN_COUNTER.increment()
+    return subprocess.run(argv, **kwargs)
+
+
+class AsyncEngine:
+    """Long-lived asyncio loop that runs per-PID/per-cwd lookups for --watch/--serve.
+
+    Subprocesses start with asyncio.create_subprocess_exec, at most
+    max_concurrency at once, and are killed when they outlive their
+    timeout. Blocking reads that do not fork (HEAD files, /proc) go to an
+    executor of the same size that lives as long as the engine, so a cycle
+    creates no threads of its own.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_CONCURRENCY):
+        import asyncio
+        import concurrent.futures
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        self.semaphore = None
+
+    async def run_command(self, argv, timeout=None):
+        """Async run_command: returns a CompletedProcess with text stdout."""
+        import asyncio
+        import subprocess
+        if self.semaphore is None:
+            # Created lazily so it belongs to this engine's loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            SPAWN_COUNTER.increment()
+            process = await asyncio.create_subprocess_exec(
+                *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(argv, timeout) from None
+            finally:
+                # Also reached when the lookup is cancelled at the cycle deadline
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+        return subprocess.CompletedProcess(
+            argv, process.returncode, stdout.decode("utf-8", "replace"), ""
+        )
+
+    async def to_thread(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def _lookups(self, func, keys, within, kwargs):
+        import asyncio
+        import subprocess
+        keys = list(keys)
+        tasks = [
+            self.loop.create_task(func(key, engine=self, **kwargs)) for key in keys
+        ]
+        if not tasks:
+            return {}
+        done, pending = await asyncio.wait(tasks, timeout=within)
+        for task in pending:
+            task.cancel()
+        # Let cancelled lookups kill their subprocesses before the cycle moves on
+        await asyncio.gather(*pending, return_exceptions=True)
+        results = {}
+        for key, task in zip(keys, tasks):
+            if task not in done:
+                continue
+            if isinstance(task.exception(), subprocess.TimeoutExpired):
+                continue
+            results[key] = task.result()
+        return results
+
+    def lookups(self, func, keys, within=None, **kwargs):
+        """Run coroutine func(key, engine=self, **kwargs) for every key concurrently.
+
+        Returns {key: result} for lookups that finished within `within`
+        seconds; the rest are cancelled and left out, like ones that
+        raised subprocess.TimeoutExpired.
+        """
+        return self.loop.run_until_complete(self._lookups(func, keys, within, kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.loop.close()
+
+
+def thread_lookups(pool, func, keys, within=None, **kwargs):
+    """Thread-pool counterpart of AsyncEngine.lookups for one-shot runs.
+
+    Lookups still running after `within` seconds are abandoned rather than joined.
+    """
+    import concurrent.futures
+    import subprocess
+    futures = {key: pool.submit(func, key, **kwargs) for key in keys}
+    concurrent.futures.wait(futures.values(), timeout=within)
+    results = {}
+    for key, future in futures.items():
+        if not future.done() or isinstance(future.exception(), subprocess.TimeoutExpired):
+            continue
+        results[key] = future.result()
+    return results
+
+
+def serial_lookups(func, keys, within=None, **kwargs):
+    """In-thread counterpart of thread_lookups for collectors that never fork.
+
+    Keys not yet started when `within` seconds have passed are skipped.
+    """
+    deadline = Deadline(within)
+    results = {}
+    for key in keys:
+        if deadline.expired():
+            break
+        results[key] = func(key, **kwargs)
+    return results
+
+
+class CycleProfiler:
+    """Per-stage wall time and subprocess counts for one collection cycle."""
+
+    def __init__(self, clock=time.perf_counter, counter=SPAWN_COUNTER):
+        self.clock = clock
+        self.counter = counter
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self.clock()
+        spawned_before = self.counter.value
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "subprocesses": 0})
+            entry["seconds"] += self.clock() - start
+            entry["subprocesses"] += self.counter.value - spawned_before
+
+    def report(self):
+        """Return a JSON-ready summary: totals plus per-stage ms and spawn counts."""
+        stages = {
+            name: {
+                "ms": round(entry["seconds"] * 1000, 3),
+                "subprocesses": entry["subprocesses"],
+            }
+            for name, entry in self.stages.items()
+        }
+        return {
+            "total_ms": round(sum(e["seconds"] for e in self.stages.values()) * 1000, 3),
+            "subprocesses": sum(e["subprocesses"] for e in self.stages.values()),
+            "stages": stages,
+        }
+
+
+class CollectionTimeout(Exception):
+    """The process table could not be read within the cycle deadline."""
+
+
+class Deadline:
+    """Time budget for one collection cycle. A budget of None is unlimited."""
+
+    def __init__(self, budget=None, clock=time.monotonic):
+        self.budget = budget
+        self.clock = clock
+        self.expires_at = None if budget is None else clock() + budget
+
+    def remaining(self):
+        """Seconds left (never negative), or None when unlimited."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - self.clock())
+
+    def expired(self):
+        return self.expires_at is not None and self.remaining() <= 0
+
+    def slice(self, share=1.0, cap=None):
+        """Return a timeout for one stage: share of the budget, bounded by what is left."""
+        if self.expires_at is None:
+            return cap
+        timeout = min(self.remaining(), self.budget * share)
+        return timeout if cap is None else min(timeout, cap)
+
+
+def format_timings(timings):
+    """Format a CycleProfiler report as a one-line table footer."""
+    parts = []
+    for name, entry in timings["stages"].items():
+        part = f"{name} {entry['ms']:.1f}ms"
+        if entry["subprocesses"]:
+            part += f" ({entry['subprocesses']})"
+        parts.append(part)
+    noun = "subprocess" if timings["subprocesses"] == 1 else "subprocesses"
+    return (
+        f"  profile: {timings['total_ms']:.1f}ms, {timings['subprocesses']} {noun}"
+        + (f"; {', '.join(parts)}" if parts else "")
+    )
+
+
+class ProcessTree:
+    """Parent/child index over a whole process table, built once per cycle.
+
+    Ancestor questions are answered by walking up parent links with a memo
+    shared by every query on the tree, so each process is visited at most
+    once per kind of question however many sessions ask. The child index
+    for descendant (subtree) queries is built on first use. PPID cycles,
+    which PID reuse can briefly produce, end a walk instead of looping.
+    """
+
+    def __init__(self, parent_map):
+        self.parents = parent_map
+        self._children = None
+
+    def _walk_up(self, pid, memo, found):
+        """Return memo[pid]: whether any strict ancestor of pid satisfies found()."""
+        path = []
+        on_path = set()
+        node = pid
+        result = False
+        while node not in memo:
+            path.append(node)
+            on_path.add(node)
+            parent = self.parents.get(node)
+            if parent is None or parent <= 0 or parent in on_path:
+                break
+            if found(parent):
+                result = True
+                break
+            node = parent
+        else:
+            result = memo[node]
+        # Resolve the walked path top-down, so later walks stop where this one did
+        for index in range(len(path) - 1, -1, -1):
+            node = path[index]
+            if index < len(path) - 1:
+                above = path[index + 1]
+                result = found(above) or memo[above]
+            memo[node] = result
+        return memo[pid]
+
+    def outermost(self, pids):
+        """Return pids minus any with an ancestor (however distant) also in pids, in order."""
+        marked = set(pids)
+        memo = {}
+        return [pid for pid in pids if not self._walk_up(pid, memo, marked.__contains__)]
+
+    def children(self):
+        """Return {pid: [child pids]}, built from every process on first use."""
+        if self._children is None:
+            children = {}
+            for pid, parent in self.parents.items():
+                if parent != pid:
+                    children.setdefault(parent, []).append(pid)
+            self._children = children
+        return self._children
+
+    def subtree(self, pid):
+        """Return pid and all its descendants, pid first."""
+        children = self.children()
+        result = [pid]
+        seen = {pid}
+        index = 0
+        while index < len(result):
+            for child in children.get(result[index], ()):
+                if child not in seen:
+                    seen.add(child)
+                    result.append(child)
+            index += 1
+        return result
+
+
+def dedupe_nested_pids(pids, parent_map):
+    """Drop PID if any ancestor is also in pids."""
+    return ProcessTree(parent_map).outermost(pids)
+
+
+def get_cwd(pid):
+    """Resolve working directory for a process via lsof."""
+    try:
+        result = run_command(
+            ["lsof", "-a", "-p", str(pid), "-d", "cwd", "-Fn"],
+            capture_output=True,
+            text=True,
+        )
+        for line in result.stdout.strip().split("\n"):
+            if line.startswith("n"):
+                return line[1:]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def get_cwds(pids, timeout=None):
+    """Resolve working directories for multiple PIDs in a single lsof call.
+
+    Raises subprocess.TimeoutExpired if lsof outlives timeout (e.g. a hung
+    NFS cwd), so the caller can retry instead of caching an empty answer.
+    """
+    if not pids:
+        return {}
+    pid_str = ",".join(str(p) for p in pids)
+    try:
+        result = run_command(
+            ["lsof", "-a", "-p", pid_str, "-d", "cwd", "-Fn"],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        if result.returncode != 0 and not result.stdout.strip():
+            return {}
+    except FileNotFoundError:
+        return {}
+
+    cwds = {}
+    current_pid = None
+    for line in result.stdout.strip().split("\n"):
+        if not line:
+            continue
+        if line.startswith("p"):
+            try:
+                current_pid = int(line[1:])
+            except ValueError:
+                current_pid = None
+        elif line.startswith("n") and current_pid is not None:
+            cwds[current_pid] = line[1:]
+    return cwds
+
+
+def surface_probe_commands(pid):
+    """ps invocations that may show GHOSTTY_SURFACE_ID, in the order to try them."""
+    return [
+        ["ps", "-p", str(pid), "-wwwE"],
+        ["ps", "-p", str(pid), "-eww", "-o", "command="],
+    ]
+
+
+def get_ghostty_surface_id(pid, timeout=None):
+    """Try to extract GHOSTTY_SURFACE_ID from process environment.
+
+    Where /proc exists the environment is read from it without forking.
+    Otherwise ps is asked; each probe is limited to timeout seconds and
+    subprocess.TimeoutExpired propagates so the caller can retry on a
+    later cycle.
+    """
+    if has_procfs():
+        return read_environ_var(pid, "GHOSTTY_SURFACE_ID", PROC_ROOT)
+    try:
+        for command in surface_probe_commands(pid):
+            result = run_command(
+                command,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+            if result.returncode != 0:
+                continue
+            match = GHOSTTY_SURFACE_RE.search(result.stdout)
+            if match:
+                return match.group(1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+async def get_ghostty_surface_id_async(pid, engine, timeout=None):
+    """get_ghostty_surface_id on an AsyncEngine."""
+    if has_procfs():
+        return await engine.to_thread(read_environ_var, pid, "GHOSTTY_SURFACE_ID", PROC_ROOT)
+    try:
+        for command in surface_probe_commands(pid):
+            result = await engine.run_command(command, timeout=timeout)
+            if result.returncode != 0:
+                continue
+            match = GHOSTTY_SURFACE_RE.search(result.stdout)
+            if match:
+                return match.group(1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def parse_etime(etime):
+    """Parse ps etime format [[DD-]HH:]MM:SS to total seconds."""
+    etime = etime.strip()
+    if not etime:
+        return None
+    days = 0
+    try:
+        if "-" in etime:
+            day_part, etime = etime.split("-", 1)
+            days = int(day_part)
+        parts = etime.split(":")
+        if len(parts) == 3:
+            hours, minutes, seconds = int(parts[0]), int(parts[1]), int(parts[2])
+        elif len(parts) == 2:
+            hours = 0
+            minutes, seconds = int(parts[0]), int(parts[1])
+        else:
+            return None
+    except ValueError:
+        return None
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def parse_cputime(cputime):
+    """Parse ps time format ([DD-]HH:MM:SS on Linux, MM:SS.ss on macOS) to seconds."""
+    cputime = cputime.strip()
+    if not cputime:
+        return None
+    days = 0
+    try:
+        if "-" in cputime:
+            day_part, cputime = cputime.split("-", 1)
+            days = int(day_part)
+        parts = cputime.split(":")
+        if len(parts) == 3:
+            hours, minutes, seconds = int(parts[0]), int(parts[1]), float(parts[2])
+        elif len(parts) == 2:
+            hours = 0
+            minutes, seconds = int(parts[0]), float(parts[1])
+        else:
+            return None
+    except ValueError:
+        return None
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+class CpuSampler:
+    """Compute %CPU over the last interval from cumulative CPU time deltas.
+
+    ps %CPU is averaged over the whole process lifetime on Linux, so a
+    long-running session barely moves when it starts or stops working.
+    Keep one sampler alive across watch cycles to classify on recent usage.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.previous = {}
+        self.last_sampled = None
+
+    def sample(self, table, pids, include_new=False):
+        """Return {pid: interval %CPU}; PIDs seen for the first time are omitted.
+
+        With include_new, a first-seen process that started since the last
+        call is included instead: all of its CPU time falls in the interval.
+        """
+        now = self.clock()
+        since, self.last_sampled = self.last_sampled, now
+        current = {}
+        usage = {}
+        for pid in pids:
+            row = table.rows.get(pid)
+            if row is None or row.get("cpu_time") is None:
+                continue
+            current[pid] = (row["cpu_time"], row["etime"], now)
+            previous = self.previous.get(pid)
+            if previous is None:
+                if (
+                    include_new
+                    and since is not None
+                    and row["etime"] is not None
+                    and row["etime"] <= now - since
+                ):
+                    usage[pid] = round(row["cpu_time"] / (now - since) * 100, 1)
+                continue
+            prev_cpu_time, prev_etime, prev_now = previous
+            # CPU time going backwards or a younger process means the PID was reused
+            restarted = (
+                row["etime"] is not None
+                and prev_etime is not None
+                and row["etime"] < prev_etime
+            )
+            elapsed = now - prev_now
+            if restarted or row["cpu_time"] < prev_cpu_time or elapsed <= 0:
+                continue
+            usage[pid] = round((row["cpu_time"] - prev_cpu_time) / elapsed * 100, 1)
+        self.previous = current
+        return usage
+
+    def sample_subtrees(self, table, subtrees):
+        """Return {session pid: interval %CPU of its whole subtree}.
+
+        subtrees maps each session to its processes (ProcessTable.subtree).
+        Children started during the interval count in full; a session seen
+        for the first time is omitted, as in sample().
+        """
+        members = [pid for subtree in subtrees.values() for pid in subtree]
+        usage = self.sample(table, members, include_new=True)
+        return {
+            root: round(sum(usage.get(pid, 0.0) for pid in subtree), 1)
+            for root, subtree in subtrees.items()
+            if root in usage
+        }
+
+
+def read_proc_io(pid, proc_root=PROC_ROOT):
+    """Return bytes read plus written to storage by pid from /proc/<pid>/io, or None."""
+    try:
+        with open(os.path.join(proc_root, str(pid), "io"), "rb") as handle:
+            data = handle.read()
+    except OSError:
+        return None
+    total = 0
+    for line in data.splitlines():
+        name, _, value = line.partition(b":")
+        if name in (b"read_bytes", b"write_bytes"):
+            total += int(value)
+    return total
+
+
+class IoSampler:
+    """Storage I/O rate of each session's process subtree, from /proc/<pid>/io.
+
+    Like CpuSampler, keep one alive across cycles; rates need two samples.
+    Processes whose io file cannot be read (other users, no /proc) count as 0.
+    """
+
+    def __init__(self, proc_root=None, clock=time.monotonic):
+        self.proc_root = proc_root or PROC_ROOT
+        self.clock = clock
+        self.previous = {}
+        self.last_sampled = None
+
+    def sample(self, table, subtrees):
+        """Return {session pid: bytes/s over the interval}; empty on the first call."""
+        now = self.clock()
+        since, self.last_sampled = self.last_sampled, now
+        current = {}
+        rates = {}
+        for root, subtree in subtrees.items():
+            moved = 0
+            for pid in subtree:
+                total = read_proc_io(pid, self.proc_root)
+                if total is None:
+                    continue
+                key = table.process_key(pid)
+                current[key] = total
+                previous = self.previous.get(key)
+                if previous is None:
+                    etime = table.rows[pid]["etime"] if pid in table.rows else None
+                    # Started within the interval, so everything it did is new
+                    if since is not None and etime is not None and etime <= now - since:
+                        moved += total
+                elif total >= previous:
+                    moved += total - previous
+            if since is not None and now > since:
+                rates[root] = moved / (now - since)
+        self.previous = current
+        return rates
+
+
+def format_duration(seconds):
+    """Format seconds as a human-readable short duration string."""
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m"
+    if seconds < 86400:
+        h = seconds // 3600
+        m = (seconds % 3600) // 60
+        return f"{h}h{m}m" if m else f"{h}h"
+    d = seconds // 86400
+    h = (seconds % 86400) // 3600
+    return f"{d}d{h}h" if h else f"{d}d"
+
+
+class ProcessTable:
+    """Snapshot of the whole process table, read once per collection cycle.
+
+    rows maps pid -> {"ppid", "cpu", "state", "tty", "etime", "cpu_time", "start", "comm"},
+    where etime is elapsed seconds and cpu_time is cumulative CPU seconds
+    (either may be None when it could not be parsed). start is an opaque
+    process start time (ps lstart text or /proc starttime ticks) that only
+    needs to differ between two processes that shared a PID.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self._tree = None
+
+    def session_pids(self):
+        """Return PIDs of claude/codex processes, in ascending order."""
+        return sorted(
+            pid for pid, row in self.rows.items() if row["comm"] in SESSION_COMMANDS
+        )
+
+    def process_info(self, pids):
+        """Return CPU%, state and TTY for each known PID."""
+        return {
+            pid: {
+                "cpu": self.rows[pid]["cpu"],
+                "state": self.rows[pid]["state"],
+                "tty": self.rows[pid]["tty"],
+            }
+            for pid in pids
+            if pid in self.rows
+        }
+
+    def parent_map(self):
+        """Return parent PID for every process in the table."""
+        return {pid: row["ppid"] for pid, row in self.rows.items()}
+
+    def tree(self):
+        """Return the ProcessTree for this table, built on first use."""
+        if self._tree is None:
+            self._tree = ProcessTree(self.parent_map())
+        return self._tree
+
+    def subtree(self, pid):
+        """Return pid and every process below it, however deep."""
+        return self.tree().subtree(pid)
+
+    def process_key(self, pid):
+        """Return (pid, start), which stays unique when the kernel reuses a PID."""
+        row = self.rows.get(pid)
+        return (pid, row.get("start") if row is not None else None)
+
+    def uptime(self, pid):
+        """Return (seconds, formatted) uptime, or (None, '-') if unknown."""
+        row = self.rows.get(pid)
+        if row is None or row["etime"] is None:
+            return (None, "-")
+        return (row["etime"], format_duration(row["etime"]))
+
+
+PS_TABLE_FORMAT = "pid=,ppid=,pcpu=,state=,tty=,etime=,time=,lstart=,comm="
+PS_LSTART_FIELDS = 5  # e.g. "Sat Oct 17 09:00:00 2026"
+
+
+def parse_ps_table(output):
+    """Parse `ps -ax -o PS_TABLE_FORMAT` output into a ProcessTable."""
+    rows = {}
+    column_count = 7 + PS_LSTART_FIELDS + 1
+    for line in output.split("\n"):
+        # comm is last and may contain spaces (full paths on macOS)
+        parts = line.split(None, column_count - 1)
+        if len(parts) != column_count:
+            continue
+        try:
+            pid = int(parts[0])
+            ppid = int(parts[1])
+            cpu = float(parts[2])
+        except ValueError:
+            continue
+        rows[pid] = {
+            "ppid": ppid,
+            "cpu": cpu,
+            "state": parts[3],
+            "tty": parts[4],
+            "etime": parse_etime(parts[5]),
+            "cpu_time": parse_cputime(parts[6]),
+            "start": " ".join(parts[7:7 + PS_LSTART_FIELDS]),
+            "comm": parts[-1].strip(),
+        }
+    return ProcessTable(rows)
+
+
+def scan_process_table(timeout=None):
+    """Read discovery, CPU, state, TTY, parent and uptime data in one ps call."""
+    try:
+        result = run_command(
+            ["ps", "-ax", "-o", PS_TABLE_FORMAT],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        if result.returncode != 0:
+            return ProcessTable({})
+    except FileNotFoundError:
+        return ProcessTable({})
+    return parse_ps_table(result.stdout)
+
+
+GIT_OBJECT_ID_RE = re.compile(r"[0-9a-f]{40}(?:[0-9a-f]{24})?")
+GIT_BRANCH_CACHE = {}
+
+
+def git_branch_command(cwd):
+    return ["git", "-C", cwd, "rev-parse", "--abbrev-ref", "HEAD"]
+
+
+def git_rev_parse_branch(cwd, timeout=GIT_TIMEOUT):
+    """Ask git for the current branch of cwd. Returns branch name or None."""
+    import subprocess
+    try:
+        result = run_command(
+            git_branch_command(cwd),
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        if result.returncode == 0:
+            return result.stdout.strip() or None
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        pass
+    return None
+
+
+def find_git_head(cwd):
+    """Locate the HEAD file of the repository containing cwd.
+
+    Follows `gitdir:` files, so linked worktrees and submodules resolve to
+    their own HEAD. Returns the path, "" if a .git file is unreadable, or
+    None if cwd is not inside a repository.
+    """
+    path = os.path.abspath(cwd)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return os.path.join(dot_git, "HEAD")
+        if os.path.isfile(dot_git):
+            try:
+                with open(dot_git, "r", encoding="utf-8") as handle:
+                    content = handle.read().strip()
+            except OSError:
+                return ""
+            if not content.startswith("gitdir:"):
+                return ""
+            gitdir = content[len("gitdir:"):].strip()
+            return os.path.join(path, gitdir, "HEAD")
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def parse_git_head(content):
+    """Return branch name from HEAD contents, "HEAD" if detached, or None if unknown."""
+    content = content.strip()
+    if content.startswith("ref:"):
+        ref = content[len("ref:"):].strip()
+        # reftable repositories keep a placeholder here; the real ref lives elsewhere
+        if ref.startswith("refs/heads/") and ref != "refs/heads/.invalid":
+            return ref[len("refs/heads/"):]
+        return None
+    if GIT_OBJECT_ID_RE.fullmatch(content):
+        return "HEAD"
+    return None
+
+
+def read_git_branch(cwd):
+    """Resolve cwd's branch from the cache or HEAD, without running git.
+
+    Returns (branch, ask_git, cache_key). When ask_git is True the caller
+    should run git and, if cache_key is not None, store git's answer with
+    remember_git_branch so it is reused until HEAD changes.
+    """
+    if cwd is None:
+        return (None, False, None)
+
+    cached = GIT_BRANCH_CACHE.get(cwd)
+    if cached is not None:
+        head_path, signature, branch = cached
+        try:
+            st = os.stat(head_path)
+        except OSError:
+            st = None
+        if st is not None and (st.st_mtime_ns, st.st_ino, st.st_size) == signature:
+            return (branch, False, None)
+
+    head_path = find_git_head(cwd)
+    if head_path is None:
+        GIT_BRANCH_CACHE.pop(cwd, None)
+        return (None, False, None)
+    try:
+        st = os.stat(head_path)
+        with open(head_path, "r", encoding="utf-8") as handle:
+            branch = parse_git_head(handle.read())
+    except (OSError, UnicodeDecodeError):
+        return (None, True, None)
+    cache_key = (head_path, (st.st_mtime_ns, st.st_ino, st.st_size))
+    if branch is None:
+        return (None, True, cache_key)
+    GIT_BRANCH_CACHE[cwd] = cache_key + (branch,)
+    return (branch, False, None)
+
+
+def remember_git_branch(cwd, cache_key, branch):
+    if cache_key is not None:
+        GIT_BRANCH_CACHE[cwd] = cache_key + (branch,)
+
+
+def get_git_branch(cwd, timeout=GIT_TIMEOUT):
+    """Get the current git branch for a directory. Returns branch name or None.
+
+    Reads HEAD directly and caches the answer per cwd until HEAD's
+    mtime/inode changes. git itself only runs for layouts HEAD parsing
+    does not understand, limited to timeout seconds.
+    """
+    branch, ask_git, cache_key = read_git_branch(cwd)
+    if ask_git:
+        branch = git_rev_parse_branch(cwd, timeout=timeout)
+        remember_git_branch(cwd, cache_key, branch)
+    return branch
+
+
+async def get_git_branch_async(cwd, engine, timeout=GIT_TIMEOUT):
+    """get_git_branch on an AsyncEngine; HEAD is read on the engine's executor."""
+    import subprocess
+    branch, ask_git, cache_key = await engine.to_thread(read_git_branch, cwd)
+    if ask_git:
+        try:
+            result = await engine.run_command(git_branch_command(cwd), timeout=timeout)
+            branch = (result.stdout.strip() or None) if result.returncode == 0 else None
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            branch = None
+        remember_git_branch(cwd, cache_key, branch)
+    return branch
+
+
+def format_tty(tty_nr):
+    """Render a /proc tty_nr device number the way ps prints it."""
+    if tty_nr == 0:
+        return "??"
+    major = (tty_nr >> 8) & 0xFFF
+    minor = (tty_nr & 0xFF) | ((tty_nr >> 12) & 0xFFF00)
+    if 136 <= major <= 143:
+        return f"pts/{(major - 136) * 256 + minor}"
+    if major == 4:
+        return f"tty{minor}" if minor < 64 else f"ttyS{minor - 64}"
+    return f"{major}:{minor}"
+
+
+def read_proc_stat(pid, proc_root=PROC_ROOT):
+    """Parse /proc/<pid>/stat. Returns a dict of the fields we use, or None."""
+    try:
+        with open(f"{proc_root}/{pid}/stat", "rb") as handle:
+            data = handle.read()
+    except OSError:
+        return None
+    # comm may itself contain spaces or parentheses, so split on the last ')'
+    open_paren = data.find(b"(")
+    close_paren = data.rfind(b")")
+    if open_paren < 0 or close_paren < open_paren:
+        return None
+    fields = data[close_paren + 1:].split()
+    if len(fields) < 20:
+        return None
+    try:
+        return {
+            "comm": data[open_paren + 1:close_paren].decode("utf-8", "replace"),
+            "state": fields[0].decode("ascii", "replace"),
+            "ppid": int(fields[1]),
+            "pgrp": int(fields[2]),
+            "tty_nr": int(fields[4]),
+            "tpgid": int(fields[5]),
+            "utime": int(fields[11]),
+            "stime": int(fields[12]),
+            "starttime": int(fields[19]),
+        }
+    except ValueError:
+        return None
+
+
+def find_environ_var(data, name):
+    """Return name's value from NUL-separated environ bytes, or None.
+
+    Environments can run to tens of kilobytes; only the matching entry is
+    sliced out and decoded.
+    """
+    prefix = name.encode() + b"="
+    if data.startswith(prefix):
+        begin = len(prefix)
+    else:
+        found = data.find(b"\0" + prefix)
+        if found < 0:
+            return None
+        begin = found + 1 + len(prefix)
+    end = data.find(b"\0", begin)
+    value = data[begin:] if end < 0 else data[begin:end]
+    return value.decode("utf-8", "replace") or None
+
+
+def read_environ_var(pid, name, proc_root=PROC_ROOT):
+    """Read one variable from /proc/<pid>/environ. Returns None if missing."""
+    try:
+        with open(f"{proc_root}/{pid}/environ", "rb") as handle:
+            data = handle.read()
+    except OSError:
+        return None
+    return find_environ_var(data, name)
+
+
+def has_procfs():
+    """True when PROC_ROOT is a mounted Linux /proc."""
+    return os.path.isdir(f"{PROC_ROOT}/self")
+
+
+class PsCollector:
+    """Collector backend built on ps/lsof subprocesses (macOS, BSD)."""
+
+    name = "ps"
+    forks = True
+
+    def scan(self, timeout=None):
+        return scan_process_table(timeout=timeout)
+
+    def cwds(self, pids, timeout=None):
+        return get_cwds(pids, timeout=timeout)
+
+    def surface_id(self, pid, timeout=None):
+        return get_ghostty_surface_id(pid, timeout=timeout)
+
+    async def surface_id_async(self, pid, engine, timeout=None):
+        return await get_ghostty_surface_id_async(pid, engine, timeout=timeout)
+
+
+class ProcCollector:
+    """Collector backend that reads /proc directly instead of forking (Linux).
+
+    Nothing here spawns a subprocess, so the timeout arguments are accepted
+    only to match PsCollector.
+    """
+
+    name = "proc"
+    forks = False
+
+    def __init__(self, proc_root=PROC_ROOT, clock_ticks=None):
+        self.proc_root = proc_root
+        self.clock_ticks = clock_ticks or os.sysconf("SC_CLK_TCK")
+
+    def _system_uptime(self):
+        try:
+            with open(f"{self.proc_root}/uptime", "r", encoding="ascii") as handle:
+                return float(handle.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def scan(self, timeout=None):
+        try:
+            entries = os.listdir(self.proc_root)
+        except OSError:
+            return ProcessTable({})
+        uptime = self._system_uptime()
+        rows = {}
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            stat = read_proc_stat(entry, self.proc_root)
+            if stat is None:
+                continue
+            # Match ps: %CPU is total CPU time over the process lifetime
+            cpu = 0.0
+            etime = None
+            if uptime is not None:
+                elapsed = uptime - stat["starttime"] / self.clock_ticks
+                etime = max(0, int(elapsed))
+                if elapsed > 0:
+                    busy = (stat["utime"] + stat["stime"]) / self.clock_ticks
+                    cpu = round(busy / elapsed * 100, 1)
+            state = stat["state"]
+            if stat["tpgid"] == stat["pgrp"]:
+                state += "+"
+            rows[int(entry)] = {
+                "ppid": stat["ppid"],
+                "cpu": cpu,
+                "state": state,
+                "tty": format_tty(stat["tty_nr"]),
+                "etime": etime,
+                "cpu_time": (stat["utime"] + stat["stime"]) / self.clock_ticks,
+                "start": stat["starttime"],
+                "comm": stat["comm"],
+            }
+        return ProcessTable(rows)
+
+    def cwds(self, pids, timeout=None):
+        cwds = {}
+        for pid in pids:
+            try:
+                cwds[pid] = os.readlink(f"{self.proc_root}/{pid}/cwd")
+            except OSError:
+                continue
+        return cwds
+
+    def surface_id(self, pid, timeout=None):
+        return read_environ_var(pid, "GHOSTTY_SURFACE_ID", self.proc_root)
+
+    async def surface_id_async(self, pid, engine, timeout=None):
+        return await engine.to_thread(self.surface_id, pid)
+
+
+def default_collector(name="auto"):
+    """Return the collector backend for name, picking /proc on Linux for 'auto'."""
+    if name == "proc":
+        return ProcCollector()
+    if name == "ps":
+        return PsCollector()
+    if sys.platform.startswith("linux") and has_procfs():
+        return ProcCollector()
+    return PsCollector()
+
+
+def classify_status(cpu, state, cpu_threshold=DEFAULT_CPU_THRESHOLD):
+    """Classify session status based on CPU usage and process state."""
+    if "T" in state:
+        return "stopped"
+    if cpu >= cpu_threshold:
+        return "active"
+    return "idle"
+
+
+def resolve_cpu_threshold(args):
+    """Resolve CPU threshold from CLI arg, env var, or default."""
+    if args.cpu_threshold is not None:
+        return args.cpu_threshold
+
+    env_value = os.environ.get(CPU_THRESHOLD_ENV_VAR)
+    env_name = CPU_THRESHOLD_ENV_VAR
+    if env_value is None:
+        env_value = os.environ.get(LEGACY_CPU_THRESHOLD_ENV_VAR)
+        env_name = LEGACY_CPU_THRESHOLD_ENV_VAR
+    if env_value is None:
+        return DEFAULT_CPU_THRESHOLD
+
+    try:
+        threshold = float(env_value)
+    except ValueError:
+        sys.stderr.write(
+            f"  Ignoring invalid {env_name} value '{env_value}'; "
+            f"using default {DEFAULT_CPU_THRESHOLD}.\n"
+        )
+        return DEFAULT_CPU_THRESHOLD
+
+    if threshold < 0:
+        sys.stderr.write(
+            f"  Ignoring invalid {env_name} value '{env_value}'; "
+            f"using default {DEFAULT_CPU_THRESHOLD}.\n"
+        )
+        return DEFAULT_CPU_THRESHOLD
+
+    return threshold
+
+
+def send_bell():
+    """Write terminal bell character to stdout."""
+    sys.stdout.write("\a")
+    sys.stdout.flush()
+
+
+def transition_message(from_status, to_status):
+    """Return a human-readable message for a transition."""
+    if from_status == "active" and to_status == "idle":
+        return "Waiting for input"
+    if to_status == "stopped":
+        return "Session stopped"
+    if to_status == "active":
+        return "Session active"
+    return f"Status changed: {from_status} -> {to_status}"
+
+
+def osascript_notify(subtitle, message):
+    """Show a macOS notification. Text is passed as argv, never spliced into the script."""
+    import subprocess
+    script = (
+        'on run argv\n'
+        'display notification (item 2 of argv) with title "agent-status" subtitle (item 1 of argv)\n'
+        "end run"
+    )
+    try:
+        subprocess.run(
+            [
+                "osascript", "-e",
+                script,
+                subtitle,
+                message,
+            ],
+            capture_output=True,
+            timeout=ALERT_DELIVERY_TIMEOUT,
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        pass
+
+
+def send_notification(session, transition):
+    """Send a macOS desktop notification for a session transition."""
+    project = session.get("project", "unknown")
+    osascript_notify(project, transition_message(transition["from"], transition["to"]))
+
+
+def detect_transitions(previous_statuses, sessions, alert_on):
+    """Return list of transitions that match alert_on."""
+    transitions = []
+    alert_set = set(alert_on)
+    for s in sessions:
+        pid = s["pid"]
+        previous = previous_statuses.get(pid)
+        if not previous:
+            continue
+        current = s["status"]
+        if (previous, current) in alert_set:
+            transitions.append({"pid": pid, "from": previous, "to": current})
+    return transitions
+
+
+def alert_transitions(
+    sessions, transitions, cooldown_seconds=0.0, last_alerts=None, dispatcher=None
+):
+    """Send bell + desktop notifications for alertable transitions.
+
+    With a dispatcher (NotificationDispatcher) the notifications are queued
+    for its worker instead of being delivered here.
+    """
+    if not transitions:
+        return []
+    now = time.monotonic()
+    alerted = []
+    pid_to_session = {s["pid"]: s for s in sessions}
+
+    for transition in transitions:
+        key = (transition["pid"], transition["from"], transition["to"])
+        if last_alerts is not None and cooldown_seconds > 0:
+            last = last_alerts.get(key)
+            if last is not None and (now - last) < cooldown_seconds:
+                continue
+        alerted.append(transition)
+        if last_alerts is not None:
+            last_alerts[key] = now
+
+    if not alerted:
+        return []
+
+    send_bell()
+    if dispatcher is not None:
+        dispatcher.submit([
+            dict(transition, project=pid_to_session[transition["pid"]].get("project", "unknown"))
+            for transition in alerted
+            if transition["pid"] in pid_to_session
+        ])
+        return alerted
+    for transition in alerted:
+        session = pid_to_session.get(transition["pid"])
+        if session:
+            send_notification(session, transition)
+    return alerted
+
+
+TRANSITION_PHRASES = {
+    ("active", "idle"): "waiting for input",
+}
+
+
+def summarize_alerts(alerts):
+    """Build one notification dict for a batch of alerts.
+
+    Each alert is a transition dict with a "project". A single alert reads
+    like send_notification; a burst becomes e.g. "3 sessions waiting for input".
+    """
+    if len(alerts) == 1:
+        alert = alerts[0]
+        subtitle = alert["project"]
+        message = transition_message(alert["from"], alert["to"])
+    else:
+        groups = {}
+        for alert in alerts:
+            phrase = TRANSITION_PHRASES.get((alert["from"], alert["to"]), alert["to"])
+            groups[phrase] = groups.get(phrase, 0) + 1
+        message = ", ".join(
+            f"{count} {'session' if count == 1 else 'sessions'} {phrase}"
+            for phrase, count in groups.items()
+        )
+        subtitle = ", ".join(dict.fromkeys(alert["project"] for alert in alerts))
+    return {
+        "title": "agent-status",
+        "subtitle": subtitle,
+        "message": message,
+        "alerts": alerts,
+    }
+
+
+class OsascriptBackend:
+    name = "osascript"
+
+    def send(self, notification):
+        osascript_notify(notification["subtitle"], notification["message"])
+
+
+class NotifySendBackend:
+    name = "notify-send"
+
+    def send(self, notification):
+        import subprocess
+        try:
+            subprocess.run(
+                [
+                    "notify-send", "--app-name=agent-status",
+                    notification["subtitle"], notification["message"],
+                ],
+                capture_output=True,
+                timeout=ALERT_DELIVERY_TIMEOUT,
+            )
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            pass
+
+
+class CommandBackend:
+    """Run a user hook: notification JSON on stdin, summary fields in the environment."""
+
+    name = "command"
+
+    def __init__(self, command):
+        self.command = command
+
+    def send(self, notification):
+        import json
+        import subprocess
+        env = dict(
+            os.environ,
+            AGENT_STATUS_TITLE=notification["title"],
+            AGENT_STATUS_SUBTITLE=notification["subtitle"],
+            AGENT_STATUS_MESSAGE=notification["message"],
+            AGENT_STATUS_COUNT=str(len(notification["alerts"])),
+        )
+        try:
+            subprocess.run(
+                self.command,
+                shell=True,
+                input=json.dumps(notification),
+                text=True,
+                env=env,
+                capture_output=True,
+                timeout=ALERT_DELIVERY_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def unix_http_connection_class():
+    """Return an HTTPConnection subclass that talks over a Unix domain socket.
+
+    Built on first use so http.client is only imported when a webhook fires.
+    """
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def __init__(self, path, timeout=ALERT_DELIVERY_TIMEOUT):
+            super().__init__("localhost", timeout=timeout)
+            self.socket_path = path
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.socket_path)
+
+    return UnixHTTPConnection
+
+
+class WebhookBackend:
+    """POST the notification as JSON to an http(s) URL or a unix:/path socket."""
+
+    name = "webhook"
+
+    def __init__(self, url):
+        self.url = url
+
+    def send(self, notification):
+        import http.client
+        import json
+        import urllib.request
+        body = json.dumps(notification).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        try:
+            if self.url.startswith("unix:"):
+                connection = unix_http_connection_class()(self.url[len("unix:"):])
+                try:
+                    connection.request("POST", "/", body=body, headers=headers)
+                    connection.getresponse().read()
+                finally:
+                    connection.close()
+            else:
+                request = urllib.request.Request(self.url, data=body, headers=headers)
+                with urllib.request.urlopen(request, timeout=ALERT_DELIVERY_TIMEOUT) as response:
+                    response.read()
+        except (OSError, http.client.HTTPException):
+            pass
+
+
+def build_notification_backends(args):
+    """Return the backends selected by the --alert-* options."""
+    backends = []
+    desktop = args.alert_desktop
+    if desktop == "auto":
+        desktop = "osascript" if sys.platform == "darwin" else "notify-send"
+    if desktop == "osascript":
+        backends.append(OsascriptBackend())
+    elif desktop == "notify-send":
+        backends.append(NotifySendBackend())
+    if args.alert_command:
+        backends.append(CommandBackend(args.alert_command))
+    if args.alert_webhook:
+        backends.append(WebhookBackend(args.alert_webhook))
+    return backends
+
+
+class NotificationDispatcher:
+    """Delivers notifications from a background worker so alerts never delay a redraw.
+
+    submit() only enqueues. The worker waits coalesce_seconds after the
+    first batch for more, then sends one summary notification to every
+    backend. Batches queued while it was delivering are merged into the
+    next summary.
+    """
+
+    def __init__(self, backends, coalesce_seconds=DEFAULT_ALERT_COALESCE):
+        import queue
+        self.backends = backends
+        self.coalesce_seconds = coalesce_seconds
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name="agent-status-alerts", daemon=True)
+        self.worker.start()
+
+    def submit(self, alerts):
+        if alerts:
+            self.queue.put(list(alerts))
+
+    def _collect_burst(self, first):
+        import queue
+        alerts = list(first)
+        deadline = time.monotonic() + self.coalesce_seconds
+        while True:
+            try:
+                batch = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return alerts, False
+            if batch is None:
+                return alerts, True
+            alerts.extend(batch)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            alerts, stopping = self._collect_burst(batch)
+            notification = summarize_alerts(alerts)
+            for backend in self.backends:
+                try:
+                    backend.send(notification)
+                except Exception:
+                    # A broken hook must not take the other backends (or the worker) down
+                    continue
+            if stopping:
+                return
+
+    def close(self, timeout=ALERT_DELIVERY_TIMEOUT):
+        """Deliver what is queued, waiting at most timeout seconds."""
+        self.queue.put(None)
+        self.worker.join(timeout)
+
+
+def disambiguate_projects(sessions):
+    """If two sessions share a project basename, prepend parent dir."""
+    name_counts = {}
+    for s in sessions:
+        name = s["project"]
+        name_counts[name] = name_counts.get(name, 0) + 1
+
+    for s in sessions:
+        if name_counts[s["project"]] > 1 and s.get("cwd"):
+            parent = os.path.basename(os.path.dirname(s["cwd"]))
+            s["project"] = f"{parent}/{s['project']}"
+
+
+def resolve_registry_path():
+    """Return registry path for session registrations."""
+    return os.environ.get(REGISTRY_ENV_VAR, DEFAULT_REGISTRY_PATH)
+
+
+class RegistryReader:
+    """Incremental reader for the registration log, indexed by PID.
+
+    Keep one reader alive across watch cycles: it remembers the byte offset
+    and inode it has consumed and only parses lines appended since, so a
+    steady-state refresh costs a single stat. It starts over when the file
+    is replaced (compaction) or truncated.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or resolve_registry_path()
+        self.reset()
+
+    def reset(self):
+        self.records = {}
+        self.identity = None
+        self.offset = 0
+        self.pending = b""
+
+    def refresh(self):
+        """Consume any newly appended lines."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.reset()
+            return
+        if (st.st_dev, st.st_ino) != self.identity or st.st_size < self.offset:
+            self.reset()
+        elif st.st_size == self.offset:
+            return
+
+        import json
+        try:
+            with open(self.path, "rb") as handle:
+                st = os.fstat(handle.fileno())
+                # The file may have been swapped between stat and open
+                if (st.st_dev, st.st_ino) != self.identity or st.st_size < self.offset:
+                    self.reset()
+                    self.identity = (st.st_dev, st.st_ino)
+                handle.seek(self.offset)
+                data = handle.read()
+        except FileNotFoundError:
+            self.reset()
+            return
+        self.offset += len(data)
+
+        lines = (self.pending + data).split(b"\n")
+        # Keep a trailing partial line until its newline has been written
+        self.pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "pid" in record:
+                self.records[record["pid"]] = record
+
+    def lookup(self, pids):
+        """Refresh, then return the latest registration for each of pids."""
+        self.refresh()
+        return {pid: self.records[pid] for pid in pids if pid in self.records}
+
+
+def load_registrations(pids, registry_path=None):
+    """Load registration metadata for the given PIDs."""
+    if not pids:
+        return {}
+    return RegistryReader(registry_path).lookup(pids)
+
+
+@contextlib.contextmanager
+def registry_lock(path):
+    """Hold the advisory lock shared with cc's registry appends."""
+    with open(path + REGISTRY_LOCK_SUFFIX, "a") as lock_handle:
+        fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_UN)
+
+
+def pid_exists(pid):
+    """Return True if a process with pid is running."""
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def iter_registry_records(handle):
+    """Yield (line, record) for each valid JSON line in an open registry file."""
+    import json
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        yield line, record
+
+
+def compact_registry(path, keep=1000, prune_dead=False):
+    """Rewrite registry with the newest record per PID, keeping the last N.
+
+    Streams the file twice rather than loading it, so memory is bounded by
+    the number of distinct PIDs. Holds the registry lock throughout so a
+    concurrent cc append is never lost. With prune_dead, records for PIDs
+    that are no longer running are dropped too.
+    """
+    if not os.path.exists(path):
+        return (0, 0, False)
+
+    with registry_lock(path):
+        # Pass 1: find the newest line for each PID
+        newest = {}
+        total = 0
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                for index, (_line, record) in enumerate(iter_registry_records(handle)):
+                    total += 1
+                    pid = record.get("pid") if isinstance(record, dict) else None
+                    newest[pid if pid is not None else ("line", index)] = index
+        except FileNotFoundError:
+            return (0, 0, False)
+
+        candidates = sorted(
+            index
+            for key, index in newest.items()
+            if not prune_dead or pid_exists(key)
+        )
+        kept = set(candidates[-keep:]) if keep > 0 else set()
+        newest.clear()
+
+        # Pass 2: stream the kept lines into a replacement file
+        tmp_path = f"{path}.tmp"
+        with open(path, "r", encoding="utf-8") as source, \
+                open(tmp_path, "w", encoding="utf-8") as target:
+            for index, (line, _record) in enumerate(iter_registry_records(source)):
+                if index in kept:
+                    target.write(line + "\n")
+        os.replace(tmp_path, path)
+
+    return (len(kept), total - len(kept), True)
+
+
+def maybe_compact_registry(path, max_bytes, keep=1000, prune_dead=False):
+    """Compact the registry once it grows past max_bytes. Returns True if compacted."""
+    try:
+        if max_bytes <= 0 or os.path.getsize(path) <= max_bytes:
+            return False
+        compact_registry(path, keep=keep, prune_dead=prune_dead)
+    except OSError:
+        return False
+    return True
+
+
+def auto_compact_registry(args):
+    """Apply --registry-max-bytes to the live registry file."""
+    return maybe_compact_registry(
+        args.registry_path or resolve_registry_path(),
+        args.registry_max_bytes,
+        keep=args.registry_keep,
+        prune_dead=args.registry_prune_dead,
+    )
+
+
+def is_subprocess_timeout(exc):
+    """True for subprocess.TimeoutExpired, without importing subprocess to check.
+
+    Only code that already ran a subprocess can raise it, so a process that
+    never forked (the /proc collector) never loads the module.
+    """
+    subprocess = sys.modules.get("subprocess")
+    return subprocess is not None and isinstance(exc, subprocess.TimeoutExpired)
+
+
+def scan_within(collector, deadline):
+    """Read the process table within deadline's scan share, or raise CollectionTimeout."""
+    try:
+        return collector.scan(timeout=deadline.slice(STAGE_BUDGET_SHARES["scan"]))
+    except Exception as exc:
+        if not is_subprocess_timeout(exc):
+            raise
+        raise CollectionTimeout(
+            f"Reading the process table took longer than {exc.timeout:.3g}s."
+        ) from exc
+
+
+def attached_session_pids(table, pids, proc_info=None):
+    """Return the TTY-attached pids, minus those nested under another session."""
+    proc_info = proc_info if proc_info is not None else table.process_info(pids)
+    # Filter to TTY-attached processes before doing per-PID lookups
+    valid_pids = [
+        pid for pid in pids
+        if pid in proc_info and proc_info[pid]["tty"] not in NO_TTY_VALUES
+    ]
+    return table.tree().outermost(valid_pids)
+
+
+def cache_entries(cache, table, pids):
+    """Return {pid: cache entry} keyed by process_key, pruning exited processes.
+
+    cache None gives fresh entries that are discarded after the call.
+    """
+    keys = {pid: table.process_key(pid) for pid in pids}
+    if cache is None:
+        return {pid: {} for pid in pids}
+    for stale in set(cache) - set(keys.values()):
+        del cache[stale]
+    return {pid: cache.setdefault(key, {}) for pid, key in keys.items()}
+
+
+def project_sessions(sessions, fields):
+    """Reduce sessions to pid plus fields, in the order given (None keeps everything)."""
+    if fields is None:
+        return sessions
+    names = ["pid"] + [name for name in fields if name != "pid"]
+    projected = []
+    for session in sessions:
+        row = {name: session.get(name) for name in names}
+        if session.get("unresolved"):
+            row["unresolved"] = session["unresolved"]
+        projected.append(row)
+    return projected
+
+
+def collect_sessions(
+    cache=None,
+    cpu_threshold=DEFAULT_CPU_THRESHOLD,
+    collector=None,
+    cpu_sampler=None,
+    registry=None,
+    profiler=None,
+    deadline=None,
+    engine=None,
+    fields=None,
+    subtree_cpu=False,
+    io_sampler=None,
+):
+    """Collect all Claude/Codex session data.
+
+    If cache (dict) is provided, CWD and surface_id are cached across calls
+    and only fetched for newly discovered processes.  Entries are keyed by
+    (pid, start time), so a reused PID starts afresh; stale ones are pruned.
+    collector selects the process data backend (see default_collector).
+    If cpu_sampler (CpuSampler) is provided, status is classified on CPU
+    usage since the previous call instead of lifetime-averaged ps %CPU.
+    If registry (RegistryReader) is provided, registrations are read
+    incrementally instead of re-parsing the whole file.
+    If profiler (CycleProfiler) is provided, it records per-stage timings.
+
+    If deadline (Deadline) is provided, every lookup gets a slice of it.
+    Fields that miss it are listed in the session's "unresolved" key and,
+    since they are not cached, fetched again on the next call. Raises
+    CollectionTimeout if the process table itself cannot be read in time.
+
+    If engine (AsyncEngine) is provided, surface IDs and branches are looked
+    up on its event loop; otherwise on a thread pool for this call only.
+
+    If fields (names from SESSION_FIELDS) is provided, sessions hold only
+    pid and those fields, and stages no requested field depends on (cwd,
+    surface and branch lookups, the registry) are skipped.
+
+    If subtree_cpu is set, a session's cpu is the sum over its whole process
+    subtree (tools, builds, test runners), taken from the same table scan.
+    If io_sampler (IoSampler) is provided, an idle session whose subtree does
+    at least DEFAULT_IO_THRESHOLD bytes/s of storage I/O is active.
+    """
+    wanted = set(SESSION_FIELDS if fields is None else fields)
+    profiler = profiler if profiler is not None else CycleProfiler()
+    collector = collector or default_collector()
+    deadline = deadline or Deadline()
+    with profiler.stage("scan"):
+        table = scan_within(collector, deadline)
+        pids = table.session_pids()
+    if not pids:
+        return []
+
+    with profiler.stage("dedupe"):
+        proc_info = table.process_info(pids)
+        valid_pids = attached_session_pids(table, pids, proc_info)
+        subtrees = None
+        if subtree_cpu or io_sampler is not None:
+            subtrees = {pid: table.subtree(pid) for pid in valid_pids}
+        if cpu_sampler is not None and subtree_cpu:
+            measured_cpu = cpu_sampler.sample_subtrees(table, subtrees)
+        elif cpu_sampler is not None:
+            measured_cpu = cpu_sampler.sample(table, valid_pids)
+        else:
+            measured_cpu = {}
+        if subtree_cpu:
+            # Without an interval sample, fall back to summing ps %CPU
+            for pid in valid_pids:
+                measured_cpu.setdefault(pid, round(sum(
+                    table.rows[member]["cpu"] for member in subtrees[pid]
+                ), 1))
+        io_rates = io_sampler.sample(table, subtrees) if io_sampler is not None else {}
+
+    registrations = {}
+    if wanted & REGISTRY_FIELDS:
+        with profiler.stage("registry"):
+            if registry is not None:
+                registrations = registry.lookup(valid_pids)
+            else:
+                registrations = load_registrations(valid_pids)
+
+    # Cache entries hold only resolved fields, so anything that timed out is retried
+    entries = cache_entries(cache, table, valid_pids)
+    unresolved = {pid: [] for pid in valid_pids}
+
+    # Batch lsof for PIDs without a known cwd only
+    cwd_pids = []
+    if wanted & CWD_FIELDS:
+        cwd_pids = [pid for pid in valid_pids if "cwd" not in entries[pid]]
+    if cwd_pids:
+        with profiler.stage("cwds"):
+            found = None
+            if not deadline.expired():
+                try:
+                    found = collector.cwds(
+                        cwd_pids, timeout=deadline.slice(STAGE_BUDGET_SHARES["cwds"])
+                    )
+                except Exception as exc:
+                    if not is_subprocess_timeout(exc):
+                        raise
+            for pid in cwd_pids:
+                if found is None:
+                    unresolved[pid].append("cwd")
+                else:
+                    entries[pid]["cwd"] = found.get(pid)
+    cwd_results = {pid: entries[pid].get("cwd") for pid in valid_pids}
+
+    # Fetch surface_id (uncached PIDs only) and branches concurrently; uptime
+    # comes from the table. Lookups that miss the deadline are abandoned.
+    want_surfaces = "surface_id" in wanted
+    want_branches = "branch" in wanted
+    pool = None
+    if engine is not None:
+        lookups = engine.lookups
+        surface_lookup, branch_lookup = collector.surface_id_async, get_git_branch_async
+    elif not collector.forks:
+        # Lookups here are a few file reads each; a pool would cost more than it saves
+        lookups = serial_lookups
+        surface_lookup, branch_lookup = collector.surface_id, get_git_branch
+    elif want_surfaces or want_branches:
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor()
+        lookups = functools.partial(thread_lookups, pool)
+        surface_lookup, branch_lookup = collector.surface_id, get_git_branch
+    sid_results = {}
+    branch_results = {}
+    try:
+        if want_surfaces:
+            with profiler.stage("surface_ids"):
+                sid_pids = [pid for pid in valid_pids if "surface_id" not in entries[pid]]
+                found = {}
+                if sid_pids and not deadline.expired():
+                    found = lookups(
+                        surface_lookup,
+                        sid_pids,
+                        deadline.remaining(),
+                        timeout=deadline.slice(STAGE_BUDGET_SHARES["surface_ids"]),
+                    )
+                for pid in sid_pids:
+                    if pid in found:
+                        entries[pid]["surface_id"] = found[pid]
+                    else:
+                        unresolved[pid].append("surface_id")
+                sid_results = {pid: entries[pid].get("surface_id") for pid in valid_pids}
+        if want_branches:
+            with profiler.stage("branches"):
+                # Dedup git branch lookups by unique CWD
+                unique_cwds = set(cwd_results.values()) - {None}
+                if unique_cwds and not deadline.expired():
+                    branch_results = lookups(
+                        branch_lookup,
+                        unique_cwds,
+                        deadline.remaining(),
+                        timeout=deadline.slice(cap=GIT_TIMEOUT),
+                    )
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    with profiler.stage("build"):
+        sessions = []
+        for pid in valid_pids:
+            info = proc_info[pid]
+            cwd = cwd_results.get(pid)
+            project = os.path.basename(cwd) if cwd else "unknown"
+            surface_id = sid_results.get(pid)
+            cpu = measured_cpu.get(pid, info["cpu"])
+            status = classify_status(cpu, info["state"], cpu_threshold=cpu_threshold)
+            if status == "idle" and io_rates.get(pid, 0.0) >= DEFAULT_IO_THRESHOLD:
+                status = "active"
+            uptime_seconds, uptime = table.uptime(pid)
+            branch = branch_results.get(cwd)
+            if want_branches and (
+                "cwd" in unresolved[pid] or (cwd is not None and cwd not in branch_results)
+            ):
+                unresolved[pid].append("branch")
+            registration = registrations.get(pid, {})
+            session = {
+                "pid": pid,
+                "project": project,
+                "cwd": cwd,
+                "branch": branch,
+                "status": status,
+                "cpu": cpu,
+                "tty": info["tty"],
+                "surface_id": surface_id,
+                "uptime_seconds": uptime_seconds,
+                "uptime": uptime,
+                "task": registration.get("task"),
+                "registered_at": registration.get("started_at"),
+            }
+            if unresolved[pid]:
+                session["unresolved"] = sorted(unresolved[pid])
+            sessions.append(session)
+
+        disambiguate_projects(sessions)
+
+        # Sort: active first, then idle, then stopped; alphabetical within each group
+        status_order = {"active": 0, "idle": 1, "stopped": 2}
+        sessions.sort(key=lambda s: (status_order.get(s["status"], 9), s["project"]))
+        if fields is not None:
+            sessions = project_sessions(sessions, fields)
+
+    return sessions
+
+
+def supports_color():
+    """Check if terminal supports color output."""
+    if os.environ.get("NO_COLOR"):
+        return False
+    return hasattr(sys.stdout, "isatty") and sys.stdout.isatty()
+
+
+STATUS_DISPLAY = {
+    "active": {"icon": "\u25cf", "label": "active", "color": "\033[32m"},
+    "idle": {"icon": "\u25d0", "label": "idle", "color": "\033[33m"},
+    "stopped": {"icon": "\u25a0", "label": "stopped", "color": "\033[90m"},
+}
+UNRESOLVED = "\u2026"
+RESET = "\033[0m"
+
+
+YELLOW = "\033[33m"
+
+
+def truncate_value(value, width):
+    """Truncate a string to width, adding ellipsis if needed."""
+    if width <= 0:
+        return ""
+    if value is None:
+        return "-"
+    text = str(value)
+    if len(text) <= width:
+        return text
+    if width == 1:
+        return "\u2026"
+    return f"{text[: width - 1]}\u2026"
+
+
+def format_table(
+    sessions,
+    transitioned_pids=None,
+    show_task=True,
+    task_width=24,
+    timings=None,
+    history=None,
+    show_sparkline=False,
+):
+    """Format sessions as an aligned table with optional ANSI colors.
+
+    Fields a deadline-limited cycle could not resolve are shown as UNRESOLVED.
+    timings (a CycleProfiler report) adds a profile footer line.
+    history ({pid: annotation} from ActivityHistory.annotations) adds how
+    long idle sessions have been idle, and a sparkline column if
+    show_sparkline is set.
+    """
+    if not sessions:
+        footer = f"\n{format_timings(timings)}\n" if timings else ""
+        return "  No active Claude/Codex sessions found.\n" + footer
+
+    use_color = supports_color()
+    transitioned_pids = transitioned_pids or set()
+    lines = []
+
+    history = history or {}
+    # Sessions merged by --aggregate say which host they run on
+    show_host = any("host" in s for s in sessions)
+    hosts = [str(s.get("host") or "-") for s in sessions]
+    max_host = max(len(h) for h in hosts)
+    projects = []
+    branches = []
+    labels = []
+    sparklines = []
+    for s in sessions:
+        unresolved = s.get("unresolved", ())
+        projects.append(UNRESOLVED if "cwd" in unresolved else s["project"])
+        branches.append(UNRESOLVED if "branch" in unresolved else s.get("branch") or "-")
+        annotation = history.get(s.get("pid"), {})
+        label = STATUS_DISPLAY[s["status"]]["label"]
+        if annotation.get("idle_for") is not None:
+            label += f" {format_duration(annotation['idle_for'])}"
+        labels.append(label)
+        sparklines.append(annotation.get("sparkline", "-"))
+
+    # Calculate column widths
+    max_project = max(len(p) for p in projects)
+    max_branch = max(len(b) for b in branches)
+    max_label = max(len(label) for label in labels)
+    max_sparkline = max(len(sparkline) for sparkline in sparklines)
+    max_uptime = max(len(s.get("uptime", "-")) for s in sessions)
+    max_task = 0
+    if show_task:
+        max_task = min(
+            task_width,
+            max(len(truncate_value(s.get("task"), task_width)) for s in sessions),
+        )
+
+    for s, host, project, branch, label, sparkline in zip(
+        sessions, hosts, projects, branches, labels, sparklines
+    ):
+        disp = STATUS_DISPLAY[s["status"]]
+        icon = disp["icon"]
+        uptime = s.get("uptime", "-")
+        identifier = s["surface_id"][:8] if s["surface_id"] else s["tty"]
+        task = truncate_value(s.get("task"), task_width) if show_task else ""
+
+        if use_color:
+            icon_str = f'{disp["color"]}{icon}{RESET}'
+        else:
+            icon_str = icon
+
+        line = f"  {icon_str} "
+        if show_host:
+            line += f"{host:<{max_host}}  "
+        line += f"{project:<{max_project}}  {branch:<{max_branch}}  {label:<{max_label}}"
+        if show_sparkline:
+            line += f"  {sparkline:<{max_sparkline}}"
+        line += f"  {uptime:<{max_uptime}}"
+        if show_task:
+            line += f"  {task:<{max_task}}"
+        line += f"  {identifier}"
+
+        if s.get("pid") in transitioned_pids:
+            if use_color:
+                line += f"  {YELLOW}<- done{RESET}"
+            else:
+                line += "  <- done"
+
+        lines.append(line)
+
+    # Summary
+    total = len(sessions)
+    counts = {}
+    for s in sessions:
+        counts[s["status"]] = counts.get(s["status"], 0) + 1
+
+    parts = []
+    for status in ("active", "idle", "stopped"):
+        if status in counts:
+            parts.append(f"{counts[status]} {status}")
+
+    summary = ", ".join(parts)
+    partial = sum(1 for s in sessions if s.get("unresolved"))
+    if partial:
+        summary += f"; {partial} unresolved"
+
+    lines.append("")
+    noun = "session" if total == 1 else "sessions"
+    lines.append(f"  {total} {noun} ({summary})")
+    if timings:
+        lines.append(format_timings(timings))
+
+    return "\n".join(lines) + "\n"
+
+
+def format_json(sessions):
+    """Format sessions as JSON."""
+    import json
+    return json.dumps(sessions, indent=2) + "\n"
+
+
+def current_utc_iso8601():
+    """Return current UTC time in RFC3339-like format."""
+    from datetime import datetime, timezone
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def format_json_v2(sessions, generated_at=None, timings=None):
+    """Format sessions as versioned JSON envelope with metadata."""
+    import json
+    payload = {
+        "schema_version": JSON_V2_SCHEMA_VERSION,
+        "generated_at": generated_at or current_utc_iso8601(),
+        "sessions": sessions,
+    }
+    if timings is not None:
+        payload["timings"] = timings
+    return json.dumps(payload, indent=2) + "\n"
+
+
+# Derivable from the snapshot's uptime and each event's generated_at, and would
+# otherwise turn every cycle into a change for every session
+DIFF_IGNORED_FIELDS = {"uptime", "uptime_seconds"}
+
+
+class DeltaStream:
+    """Turns successive session lists into sequenced NDJSON events.
+
+    The first call yields one "snapshot" event with every session; later
+    calls yield "added" (whole session), "removed" (pid only) and "changed"
+    (pid plus only the fields that differ) events. seq increases by one per
+    event, so a consumer can tell when it missed some.
+
+    key_fields names what identifies a session, and is repeated in every
+    event; merged multi-host sessions need ("host", "pid").
+    """
+
+    def __init__(self, key_fields=("pid",)):
+        self.seq = 0
+        self.previous = None
+        self.key_fields = key_fields
+
+    def _event(self, event_type, generated_at, **fields):
+        self.seq += 1
+        event = {"seq": self.seq, "type": event_type, "generated_at": generated_at}
+        event.update(fields)
+        return event
+
+    def events(self, sessions, generated_at=None):
+        generated_at = generated_at or current_utc_iso8601()
+        current = {self._key(s): s for s in sessions}
+        previous, self.previous = self.previous, current
+        if previous is None:
+            return [self._event("snapshot", generated_at, sessions=sessions)]
+
+        events = []
+        for s in sessions:
+            identity = self._identity(s)
+            before = previous.get(self._key(s))
+            if before is None:
+                events.append(self._event("added", generated_at, **identity, session=s))
+                continue
+            changed = {
+                key: s.get(key)
+                for key in set(s) | set(before)
+                if key not in DIFF_IGNORED_FIELDS and s.get(key) != before.get(key)
+            }
+            if changed:
+                fields = dict(sorted(changed.items()))
+                events.append(self._event("changed", generated_at, **identity, fields=fields))
+        for key, before in previous.items():
+            if key not in current:
+                events.append(self._event("removed", generated_at, **self._identity(before)))
+        return events
+
+    def _key(self, session):
+        return tuple(session.get(name) for name in self.key_fields)
+
+    def _identity(self, session):
+        return {name: session.get(name) for name in self.key_fields}
+
+    def format(self, sessions, generated_at=None):
+        """Return the events for sessions as NDJSON text ("" if nothing changed)."""
+        import json
+        return "".join(
+            json.dumps(event, separators=(",", ":")) + "\n"
+            for event in self.events(sessions, generated_at=generated_at)
+        )
+
+
+def resolve_watch_interval(args, sessions):
+    """Resolve watch-mode sleep interval, optionally adapting by activity."""
+    has_active = any(s["status"] == "active" for s in sessions)
+    if has_active:
+        return args.interval_active if args.interval_active is not None else args.interval
+    return args.interval_idle if args.interval_idle is not None else args.interval
+
+
+def next_cycle_time(previous, interval, now):
+    """Return the first tick of previous's interval grid that is after now.
+
+    Watch mode sleeps until this tick rather than for interval after the
+    work, so collection time does not add to the refresh period. A cycle
+    that overruns skips the ticks it missed instead of running back to back.
+    """
+    scheduled = previous + interval
+    if scheduled <= now:
+        scheduled += (int((now - scheduled) // interval) + 1) * interval
+    return scheduled
+
+
+def mark_unresolved(sessions, fields):
+    """Return copies of sessions with fields added to their "unresolved" list."""
+    marked = []
+    for s in sessions:
+        s = dict(s)
+        s["unresolved"] = sorted(set(s.get("unresolved", ())) | set(fields))
+        marked.append(s)
+    return marked
+
+
+INOTIFY_EVENT = struct.Struct("iIII")
+# IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_REGISTRY_MASK = 0x002 | 0x008 | 0x080 | 0x100 | 0x200
+
+
+class SleepWaiter:
+    """Plain interval polling: waits out the whole timeout."""
+
+    name = "sleep"
+
+    def update(self, pids):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class PidfdWaiter:
+    """Wakes when a session exits (pidfd) or the registry changes (inotify). Linux.
+
+    update() is given the PIDs of the sessions on screen; wait() returns True
+    as soon as one of them exits or a registration is written, and False
+    once the timeout (the fallback poll) runs out.
+    """
+
+    name = "pidfd"
+
+    def __init__(self, registry_path):
+        import ctypes
+        self.registry_name = os.fsencode(os.path.basename(registry_path))
+        self.pidfds = {}
+        self.exited = set()
+        self.pending = False
+        self.inotify_fd = None
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return
+        directory = os.path.dirname(registry_path) or "."
+        if libc.inotify_add_watch(fd, os.fsencode(directory), INOTIFY_REGISTRY_MASK) < 0:
+            # No registry directory yet; the fallback poll still notices new sessions
+            os.close(fd)
+            return
+        self.inotify_fd = fd
+
+    def update(self, pids):
+        pids = set(pids)
+        for pid in set(self.pidfds) - pids:
+            os.close(self.pidfds.pop(pid))
+        # Remember exits already reported so a lingering zombie cannot spin the loop
+        self.exited &= pids
+        for pid in pids - set(self.pidfds) - self.exited:
+            try:
+                self.pidfds[pid] = os.pidfd_open(pid)
+            except ProcessLookupError:
+                self.exited.add(pid)
+                self.pending = True
+            except OSError:
+                continue
+
+    def _registry_changed(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                start = offset + INOTIFY_EVENT.size
+                if data[start:start + length].rstrip(b"\0") == self.registry_name:
+                    changed = True
+                offset = start + length
+
+    def wait(self, timeout):
+        if self.pending:
+            self.pending = False
+            return True
+        poller = select.poll()
+        by_fd = {fd: pid for pid, fd in self.pidfds.items()}
+        for fd in by_fd:
+            poller.register(fd, select.POLLIN)
+        if self.inotify_fd is not None:
+            poller.register(self.inotify_fd, select.POLLIN)
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            woke = False
+            for fd, _event in poller.poll(remaining * 1000):
+                if fd == self.inotify_fd:
+                    woke = self._registry_changed() or woke
+                else:
+                    pid = by_fd[fd]
+                    poller.unregister(fd)
+                    os.close(self.pidfds.pop(pid))
+                    self.exited.add(pid)
+                    woke = True
+            if woke:
+                return True
+
+    def close(self):
+        for fd in self.pidfds.values():
+            os.close(fd)
+        self.pidfds.clear()
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+class KqueueWaiter:
+    """Wakes when a session exits or the registry changes, via kqueue. macOS/BSD."""
+
+    name = "kqueue"
+
+    def __init__(self, registry_path):
+        self.registry_path = registry_path
+        self.kqueue = select.kqueue()
+        self.pids = set()
+        self.exited = set()
+        self.pending = False
+        self.vnode_fds = []
+        self._watch_registry()
+
+    def _watch_registry(self):
+        """(Re)arm vnode watches on the registry file and its directory."""
+        for fd in self.vnode_fds:
+            os.close(fd)
+        self.vnode_fds = []
+        changes = []
+        directory = os.path.dirname(self.registry_path) or "."
+        for path, fflags in (
+            # Directory writes cover the file being created or replaced by compaction
+            (directory, select.KQ_NOTE_WRITE),
+            (self.registry_path, select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND
+             | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME),
+        ):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            self.vnode_fds.append(fd)
+            changes.append(select.kevent(
+                fd,
+                filter=select.KQ_FILTER_VNODE,
+                flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                fflags=fflags,
+            ))
+        if changes:
+            self.kqueue.control(changes, 0, 0)
+
+    def update(self, pids):
+        pids = set(pids)
+        self.exited &= pids
+        # EV_ONESHOT proc filters disappear by themselves when they fire or the process exits
+        self.pids &= pids
+        changes = []
+        for pid in pids - self.pids - self.exited:
+            changes.append(select.kevent(
+                pid,
+                filter=select.KQ_FILTER_PROC,
+                flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                fflags=select.KQ_NOTE_EXIT,
+            ))
+        for change in changes:
+            try:
+                self.kqueue.control([change], 0, 0)
+                self.pids.add(change.ident)
+            except ProcessLookupError:
+                self.exited.add(change.ident)
+                self.pending = True
+            except OSError:
+                continue
+
+    def wait(self, timeout):
+        if self.pending:
+            self.pending = False
+            return True
+        events = self.kqueue.control(None, 16, max(0.0, timeout))
+        if not events:
+            return False
+        for event in events:
+            if event.filter == select.KQ_FILTER_PROC:
+                self.pids.discard(event.ident)
+                self.exited.add(event.ident)
+        if any(event.filter == select.KQ_FILTER_VNODE for event in events):
+            self._watch_registry()
+        return True
+
+    def close(self):
+        for fd in self.vnode_fds:
+            os.close(fd)
+        self.vnode_fds = []
+        self.kqueue.close()
+
+
+def make_event_waiter(registry_path=None):
+    """Return the best waiter this platform supports, or SleepWaiter as a fallback."""
+    registry_path = registry_path or resolve_registry_path()
+    try:
+        if hasattr(os, "pidfd_open") and sys.platform.startswith("linux"):
+            return PidfdWaiter(registry_path)
+        if hasattr(select, "kqueue"):
+            return KqueueWaiter(registry_path)
+    except OSError:
+        pass
+    return SleepWaiter()
+
+
+def wait_for_next_cycle(waiter, scheduled, sessions):
+    """Block until the next scheduled cycle or an earlier event. Returns the new schedule base.
+
+    An event-driven wakeup restarts the schedule, so the fallback poll
+    comes a full interval after the refresh it triggered.
+    """
+    waiter.update(s["pid"] for s in sessions)
+    if waiter.wait(max(0.0, scheduled - time.monotonic())):
+        return time.monotonic()
+    return scheduled
+
+
+def resolve_cache_path(args=None, collector=None):
+    """Return the on-disk cache path, or None when --no-cache is given.
+
+    Also None for a collector that never forks: re-reading /proc costs less
+    than loading and rewriting the cache file.
+    """
+    if args is not None and args.no_cache:
+        return None
+    if collector is not None and not collector.forks:
+        return None
+    return os.environ.get(CACHE_ENV_VAR, DEFAULT_CACHE_PATH)
+
+
+def load_disk_cache(path):
+    """Read a cache written by save_disk_cache into a collect_sessions cache dict.
+
+    Branch entries are put back into GIT_BRANCH_CACHE, where read_git_branch
+    checks them against HEAD's stat before use. Process entries need no
+    check here: collect_sessions drops any whose (pid, start) is not in the
+    current process table. A missing, corrupt or foreign file gives {}.
+    """
+    import json
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            data = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != DISK_CACHE_VERSION:
+        return {}
+    cache = {}
+    try:
+        for entry in data.get("processes", []):
+            cache[(entry["pid"], entry["start"])] = dict(entry["fields"])
+        for entry in data.get("branches", []):
+            GIT_BRANCH_CACHE.setdefault(
+                entry["cwd"],
+                (entry["head"], tuple(entry["signature"]), entry["branch"]),
+            )
+    except (KeyError, TypeError, ValueError):
+        return {}
+    return cache
+
+
+def format_disk_cache(cache):
+    """Serialize a collect_sessions cache plus the branches its cwds resolved to."""
+    import json
+    cwds = {fields.get("cwd") for fields in cache.values()}
+    processes = [
+        {"pid": pid, "start": start, "fields": fields}
+        for (pid, start), fields in sorted(cache.items(), key=lambda item: item[0][0])
+    ]
+    branches = [
+        {"cwd": cwd, "head": head, "signature": list(signature), "branch": branch}
+        for cwd, (head, signature, branch) in sorted(GIT_BRANCH_CACHE.items())
+        if cwd in cwds
+    ]
+    return json.dumps(
+        {"version": DISK_CACHE_VERSION, "processes": processes, "branches": branches},
+        separators=(",", ":"),
+    )
+
+
+def save_disk_cache(path, cache):
+    """Atomically replace path with cache; skipped when nothing changed."""
+    content = format_disk_cache(cache)
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            if handle.read() == content:
+                return
+    except OSError:
+        pass
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            handle.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is only an accelerator; a read-only home must not fail the run
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+
+@contextlib.contextmanager
+def persistent_cache(path):
+    """Yield a collect_sessions cache loaded from path, saved back on success.
+
+    path None yields None, so collection runs uncached.
+    """
+    if path is None:
+        yield None
+        return
+    cache = load_disk_cache(path)
+    yield cache
+    save_disk_cache(path, cache)
+
+
+def resolve_history_path():
+    """Return the activity history path from the environment or default."""
+    return os.environ.get(HISTORY_ENV_VAR, DEFAULT_HISTORY_PATH)
+
+
+def subtree_io_enabled(args):
+    """Return True if --subtree-io can be honoured: a --watch/--serve loop on /proc."""
+    return args.subtree_io and (args.watch or args.serve) and has_procfs()
+
+
+def history_enabled(args):
+    """Return True if this run records activity samples (--watch/--serve)."""
+    return (args.watch or args.serve) and not args.no_history
+
+
+class HistoryRing:
+    """A memory-mapped ring of fixed-width HISTORY_RECORD samples.
+
+    The file is sized once, when it is created (or found unusable), and
+    appends overwrite the oldest slot after that, so it never grows. An
+    existing file keeps the capacity in its header. Readers and writers
+    serialize with flock on the file itself; --watch and --serve may both
+    be appending.
+    """
+
+    def __init__(self, path, capacity=HISTORY_CAPACITY, writable=True):
+        import mmap
+        self.path = path
+        if writable:
+            os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        else:
+            self.fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if writable else fcntl.LOCK_SH)
+            try:
+                self.capacity = self._read_capacity()
+                if self.capacity is None:
+                    if not writable:
+                        raise ValueError(f"{path} is not an agent-status history file")
+                    self.capacity = capacity
+                    self._initialize()
+                size = HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size
+                access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+                self.map = mmap.mmap(self.fd, size, access=access)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _read_capacity(self):
+        """Return the capacity of a valid existing file, or None."""
+        header = os.pread(self.fd, HISTORY_HEADER.size, 0)
+        if len(header) != HISTORY_HEADER.size:
+            return None
+        magic, record_size, capacity, _written = HISTORY_HEADER.unpack(header)
+        if magic != HISTORY_MAGIC or record_size != HISTORY_RECORD.size or capacity <= 0:
+            return None
+        if os.fstat(self.fd).st_size != HISTORY_HEADER.size + capacity * HISTORY_RECORD.size:
+            return None
+        return capacity
+
+    def _initialize(self):
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size)
+        header = HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_RECORD.size, self.capacity, 0)
+        os.pwrite(self.fd, header, 0)
+
+    def _written(self):
+        return HISTORY_HEADER.unpack_from(self.map, 0)[3]
+
+    def append(self, samples):
+        """Write (pid, start, timestamp, cpu, status code) samples over the oldest slots."""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            written = self._written()
+            for sample in samples:
+                slot = written % self.capacity
+                HISTORY_RECORD.pack_into(
+                    self.map, HISTORY_HEADER.size + slot * HISTORY_RECORD.size, *sample
+                )
+                written += 1
+            HISTORY_HEADER.pack_into(
+                self.map, 0, HISTORY_MAGIC, HISTORY_RECORD.size, self.capacity, written
+            )
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def records(self):
+        """Return every stored sample as a tuple, oldest first."""
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            written = self._written()
+            count = min(written, self.capacity)
+            oldest = written % self.capacity if written > self.capacity else 0
+            base = HISTORY_HEADER.size
+            size = HISTORY_RECORD.size
+            data = (
+                self.map[base + oldest * size:base + count * size]
+                + self.map[base:base + oldest * size]
+            )
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return list(HISTORY_RECORD.iter_unpack(data))
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def open_history(path, writable=True):
+    """Return a HistoryRing for path, or None if it cannot be opened.
+
+    History is a convenience, so a missing file (for readers), a read-only
+    home or a foreign file just means there is none.
+    """
+    try:
+        return HistoryRing(path, writable=writable)
+    except (OSError, ValueError):
+        return None
+
+
+def format_sparkline(values, width=SPARKLINE_WIDTH):
+    """Render the last width %CPU values as block characters."""
+    values = list(values)[-width:]
+    if not values:
+        return "-"
+    scale = max(max(values), SPARKLINE_MIN_SCALE)
+    top = len(SPARKLINE_BLOCKS) - 1
+    return "".join(
+        SPARKLINE_BLOCKS[min(top, max(0, round(value / scale * top)))] for value in values
+    )
+
+
+class ActivityHistory:
+    """Per-session activity from a HistoryRing: recent CPU and time in the current status.
+
+    Sessions are identified by (pid, start), where start is the process
+    start time in epoch seconds, so a reused PID starts a new history.
+    """
+
+    def __init__(self, ring=None, sample_seconds=HISTORY_SAMPLE_SECONDS):
+        self.ring = ring
+        self.sample_seconds = sample_seconds
+        self.states = {}
+        self.status_names = {code: name for name, code in HISTORY_STATUS_CODES.items()}
+        if ring is not None:
+            self.load(ring.records())
+
+    def load(self, records):
+        """Build states from records (oldest first), as if each had been remember()ed.
+
+        Walks newest to oldest and stops looking at a session once its
+        sparkline is full and the start of its current status is found,
+        since a full ring holds far more than either needs.
+        """
+        done = set()
+        for pid, start, timestamp, cpu, code in reversed(records):
+            key = (pid, start)
+            if key in done:
+                continue
+            status = self.status_names.get(code)
+            state = self.states.get(key)
+            if state is None:
+                self.states[key] = {
+                    "cpu": [cpu], "status": status, "since": timestamp,
+                    "sampled": timestamp, "settled": False,
+                }
+                continue
+            if not state["settled"]:
+                if status == state["status"]:
+                    state["since"] = timestamp
+                else:
+                    state["settled"] = True
+            if len(state["cpu"]) < SPARKLINE_WIDTH:
+                state["cpu"].insert(0, cpu)
+            if state["settled"] and len(state["cpu"]) >= SPARKLINE_WIDTH:
+                done.add(key)
+        for state in self.states.values():
+            del state["settled"]
+
+    def remember(self, pid, start, timestamp, cpu, code):
+        """Add one HistoryRing record to the in-memory state; returns the session's state."""
+        state = self.states.get((pid, start))
+        if state is None:
+            state = self.states[(pid, start)] = {"cpu": [], "status": None, "since": timestamp}
+        status = self.status_names.get(code)
+        if status != state["status"]:
+            state["status"] = status
+            state["since"] = timestamp
+        state["cpu"].append(cpu)
+        if len(state["cpu"]) > SPARKLINE_WIDTH:
+            del state["cpu"][0]
+        state["sampled"] = timestamp
+        return state
+
+    def _key(self, session, now):
+        """Return the (pid, start) key for a session, or None without an uptime."""
+        if session.get("uptime_seconds") is None:
+            return None
+        pid = session["pid"]
+        start = int(round(now - session["uptime_seconds"]))
+        for offset in range(HISTORY_START_SLACK + 1):
+            for candidate in {start - offset, start + offset}:
+                if (pid, candidate) in self.states:
+                    return (pid, candidate)
+        return (pid, start)
+
+    def record(self, sessions, now=None):
+        """Sample sessions whose status changed or whose last sample is old enough.
+
+        Sessions no longer running are forgotten here (the file keeps them).
+        """
+        now = time.time() if now is None else now
+        samples = []
+        seen = set()
+        for session in sessions:
+            key = self._key(session, now)
+            unresolved = session.get("unresolved", ())
+            if key is None or "status" in unresolved or "cpu" in unresolved:
+                continue
+            seen.add(key)
+            state = self.states.get(key)
+            if (
+                state is not None
+                and state["status"] == session["status"]
+                and now - state["sampled"] < self.sample_seconds
+            ):
+                continue
+            sample = (
+                key[0], key[1], now, session.get("cpu") or 0.0,
+                HISTORY_STATUS_CODES[session["status"]],
+            )
+            self.remember(*sample)
+            samples.append(sample)
+        for key in set(self.states) - seen:
+            del self.states[key]
+        if samples and self.ring is not None:
+            self.ring.append(samples)
+
+    def annotations(self, sessions, now=None):
+        """Return {pid: {"sparkline": str, "idle_for": seconds or None}} for the table."""
+        now = time.time() if now is None else now
+        result = {}
+        for session in sessions:
+            key = self._key(session, now)
+            state = self.states.get(key) if key is not None else None
+            if state is None:
+                continue
+            idle_for = None
+            if session.get("status") == "idle" and state["status"] == "idle":
+                idle_for = max(0, int(now - state["since"]))
+            result[session["pid"]] = {
+                "sparkline": format_sparkline(state["cpu"]),
+                "idle_for": idle_for,
+            }
+        return result
+
+
+def table_history(args):
+    """Return the ActivityHistory a one-shot table reads for --sparkline, or None."""
+    if not args.sparkline:
+        return None
+    ring = open_history(resolve_history_path(), writable=False)
+    if ring is None:
+        return ActivityHistory()
+    try:
+        return ActivityHistory(ring)
+    finally:
+        ring.close()
+
+
+def format_history(records, now=None):
+    """Format HistoryRing records as one line per session, most recent first."""
+    now = time.time() if now is None else now
+    history = ActivityHistory()
+    history.load(records)
+    counts = {}
+    for pid, start, *_sample in records:
+        counts[(pid, start)] = counts.get((pid, start), 0) + 1
+    if not history.states:
+        return "  No activity recorded.\n"
+
+    rows = sorted(history.states.items(), key=lambda item: item[1]["sampled"], reverse=True)
+    use_color = supports_color()
+    labels = []
+    for _key, state in rows:
+        label = STATUS_DISPLAY[state["status"]]["label"] if state["status"] else "?"
+        labels.append(f"{label} {format_duration(max(0, int(state['sampled'] - state['since'])))}")
+    max_pid = max(len(str(key[0])) for key, _state in rows)
+    max_label = max(len(label) for label in labels)
+    lines = []
+    for (key, state), label in zip(rows, labels):
+        pid, _start = key
+        disp = STATUS_DISPLAY.get(state["status"], STATUS_DISPLAY["stopped"])
+        icon = f'{disp["color"]}{disp["icon"]}{RESET}' if use_color else disp["icon"]
+        sparkline = format_sparkline(state["cpu"])
+        seen = format_duration(max(0, int(now - state["sampled"])))
+        line = (
+            f"  {icon} {pid:>{max_pid}}  {label:<{max_label}}  {sparkline:<{SPARKLINE_WIDTH}}"
+            f"  {counts[key]:>5} samples, last {seen} ago"
+        )
+        if not pid_exists(pid):
+            line += "  (exited)"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def show_history(path):
+    """Print the history file at path. Returns the process exit status."""
+    ring = open_history(path, writable=False)
+    if ring is None:
+        sys.stderr.write(f"  No activity history at {path}.\n")
+        return 1
+    try:
+        records = ring.records()
+    finally:
+        ring.close()
+    sys.stdout.write(format_history(records))
+    return 0
+
+
+def print_snapshot(
+    json_output=False,
+    cache=None,
+    cpu_threshold=DEFAULT_CPU_THRESHOLD,
+    show_task=True,
+    task_width=24,
+    collector=None,
+    profile=False,
+    deadline=None,
+    fields=None,
+    history=None,
+    show_sparkline=False,
+    subtree_cpu=False,
+    output_fields=None,
+):
+    """Collect and print one snapshot.
+
+    JSON output holds only output_fields (None for all of them); fields may
+    add more that are collected but not shown. history (ActivityHistory)
+    annotates the table; see format_table.
+    """
+    profiler = CycleProfiler() if profile else None
+    sessions = collect_sessions(
+        cache=cache,
+        cpu_threshold=cpu_threshold,
+        collector=collector,
+        profiler=profiler,
+        deadline=deadline,
+        fields=fields,
+        subtree_cpu=subtree_cpu,
+    )
+    timings = profiler.report() if profiler else None
+    if json_output:
+        sys.stdout.write(format_json(project_sessions(sessions, output_fields)))
+        if timings:
+            # The legacy format is a bare array, so the profile goes to stderr
+            sys.stderr.write(format_timings(timings) + "\n")
+    else:
+        annotations = history.annotations(sessions) if history is not None else None
+        sys.stdout.write(
+            format_table(
+                sessions,
+                show_task=show_task,
+                task_width=task_width,
+                timings=timings,
+                history=annotations,
+                show_sparkline=show_sparkline,
+            )
+        )
+
+
+def clear_screen():
+    sys.stdout.write("\033[2J\033[H")
+    sys.stdout.flush()
+
+
+ANSI_ESCAPE_RE = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+
+class TerminalRenderer:
+    """Redraws watch output in place, rewriting only the lines that changed.
+
+    The first frame (and any frame after a resize, or one with lines too
+    wide to address reliably) clears the screen and writes everything.
+    After that each changed line is rewritten at its row with cursor
+    addressing, and an unchanged frame writes nothing at all.
+    """
+
+    def __init__(self):
+        self.lines = None
+        self.size = None
+
+    def render(self, text):
+        import shutil
+        lines = text.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        size = shutil.get_terminal_size()
+        fits = all(len(ANSI_ESCAPE_RE.sub("", line)) < size.columns for line in lines)
+        if self.lines is None or size != self.size or not fits or len(lines) >= size.lines:
+            clear_screen()
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            # Wrapped or scrolled output cannot be patched by row next time
+            self.lines = lines if fits and len(lines) < size.lines else None
+            self.size = size
+            return
+        if lines == self.lines:
+            return
+
+        out = []
+        for row, line in enumerate(lines, start=1):
+            if row > len(self.lines) or self.lines[row - 1] != line:
+                out.append(f"\033[{row};1H{line}\033[K")
+        if len(lines) < len(self.lines):
+            out.append(f"\033[{len(lines) + 1};1H\033[J")
+        # Leave the cursor where a full redraw would have
+        out.append(f"\033[{len(lines) + 1};1H")
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+        self.lines = lines
+
+
+def focus_ghostty_surface(surface_id):
+    """Focus a Ghostty surface via its URL scheme. Returns True on success."""
+    import subprocess
+    try:
+        result = subprocess.run(
+            ["open", f"ghostty://present-surface/{surface_id}"],
+            capture_output=True,
+            text=True,
+        )
+        return result.returncode == 0
+    except FileNotFoundError:
+        return False
+
+
+def collect_goto_sessions(cache=None, collector=None, deadline=None):
+    """Collect just enough for --goto to match sessions by project name.
+
+    Returns sessions with pid, project, cwd, start and uptime_seconds, from
+    one scan and one batched cwd lookup. surface_id is included only when
+    cache already knows it; resolve_goto_surface fetches it for the match.
+    Branches, CPU status and registrations are skipped.
+    """
+    collector = collector or default_collector()
+    deadline = deadline or Deadline()
+    table = scan_within(collector, deadline)
+    pids = attached_session_pids(table, table.session_pids())
+    entries = cache_entries(cache, table, pids)
+
+    cwd_pids = [pid for pid in pids if "cwd" not in entries[pid]]
+    if cwd_pids and not deadline.expired():
+        try:
+            found = collector.cwds(cwd_pids, timeout=deadline.slice(STAGE_BUDGET_SHARES["cwds"]))
+        except Exception as exc:
+            if not is_subprocess_timeout(exc):
+                raise
+        else:
+            for pid in cwd_pids:
+                entries[pid]["cwd"] = found.get(pid)
+
+    sessions = []
+    for pid in pids:
+        entry = entries[pid]
+        cwd = entry.get("cwd")
+        session = {
+            "pid": pid,
+            "project": os.path.basename(cwd) if cwd else "unknown",
+            "cwd": cwd,
+            "start": table.process_key(pid)[1],
+            "uptime_seconds": table.uptime(pid)[0],
+        }
+        if "surface_id" in entry:
+            session["surface_id"] = entry["surface_id"]
+        if "cwd" not in entry:
+            session["unresolved"] = ["cwd"]
+        sessions.append(session)
+    # Match the names the table and the daemon show, e.g. "proj/api"
+    disambiguate_projects(sessions)
+    return sessions
+
+
+def registered_surface_id(pid, uptime_seconds, registry_path=None, now=None):
+    """Return the GHOSTTY_SURFACE_ID cc recorded when it launched pid, or None.
+
+    The registration only counts if it was written within
+    REGISTRATION_START_SLACK seconds of the process starting, so one left
+    behind by an earlier process with the same PID is ignored.
+    """
+    from datetime import datetime
+    record = load_registrations([pid], registry_path=registry_path).get(pid)
+    if not record or not record.get("ghostty_surface_id") or uptime_seconds is None:
+        return None
+    try:
+        registered_at = datetime.fromisoformat(
+            str(record.get("started_at")).replace("Z", "+00:00")
+        ).timestamp()
+    except ValueError:
+        return None
+    started_at = (time.time() if now is None else now) - uptime_seconds
+    if abs(registered_at - started_at) > REGISTRATION_START_SLACK:
+        return None
+    return record["ghostty_surface_id"]
+
+
+def resolve_goto_surface(session, collector=None, deadline=None, cache=None, registry_path=None):
+    """Fill in surface_id for a collect_goto_sessions session.
+
+    Tries the cc registration first, then asks the collector. A probe that
+    misses the deadline leaves surface_id unresolved. Returns session.
+    """
+    if "surface_id" in session:
+        return session
+    collector = collector or default_collector()
+    deadline = deadline or Deadline()
+    surface_id = registered_surface_id(
+        session["pid"], session.get("uptime_seconds"), registry_path=registry_path
+    )
+    if surface_id is None:
+        try:
+            surface_id = collector.surface_id(
+                session["pid"], timeout=deadline.slice(STAGE_BUDGET_SHARES["surface_ids"])
+            )
+        except Exception as exc:
+            if not is_subprocess_timeout(exc):
+                raise
+            session["unresolved"] = sorted(set(session.get("unresolved", [])) | {"surface_id"})
+            return session
+    session["surface_id"] = surface_id
+    if cache is not None:
+        cache.setdefault((session["pid"], session["start"]), {})["surface_id"] = surface_id
+    return session
+
+
+def find_project_matches(sessions, project_query):
+    """Find project matches using exact, then prefix, then substring."""
+    query = project_query.strip().lower()
+    if not query:
+        return (None, [])
+
+    exact = [s for s in sessions if s["project"].lower() == query]
+    if exact:
+        return ("exact", exact)
+
+    prefix = [s for s in sessions if s["project"].lower().startswith(query)]
+    if prefix:
+        return ("prefix", prefix)
+
+    substring = [s for s in sessions if query in s["project"].lower()]
+    if substring:
+        return ("substring", substring)
+
+    return (None, [])
+
+
+def handle_goto(
+    project_query,
+    collector=None,
+    deadline=None,
+    sessions=None,
+    cache=None,
+):
+    """Find a session by project name and focus its Ghostty surface.
+
+    sessions (e.g. from a running daemon) skips collection. Otherwise only
+    cwds are collected to match on, and the surface ID is looked up for the
+    single match alone; cache (see collect_sessions) serves both.
+    """
+    collected = sessions is None
+    if collected:
+        collector = collector or default_collector()
+        deadline = deadline or Deadline()
+        sessions = collect_goto_sessions(cache=cache, collector=collector, deadline=deadline)
+    match_mode, matches = find_project_matches(sessions, project_query)
+
+    if not matches:
+        sys.stderr.write(f"  No session matching '{project_query}'.\n")
+        if sessions:
+            sys.stderr.write("  Available sessions:\n")
+            for s in sessions:
+                sys.stderr.write(f"    - {s['project']}\n")
+        return 1
+
+    if len(matches) > 1:
+        mode_display = match_mode if match_mode else "project"
+        sys.stderr.write(
+            f"  Multiple {mode_display} matches for '{project_query}':\n"
+        )
+        for s in matches:
+            sys.stderr.write(f"    - {s['project']}\n")
+        sys.stderr.write("  Be more specific.\n")
+        return 1
+
+    session = matches[0]
+    if collected:
+        session = resolve_goto_surface(
+            session, collector=collector, deadline=deadline, cache=cache
+        )
+    if "surface_id" in session.get("unresolved", ()):
+        sys.stderr.write(f"  Timed out reading the Ghostty surface for '{session['project']}'.\n")
+        return 1
+    if not session.get("surface_id"):
+        sys.stderr.write(f"  Session '{session['project']}' has no Ghostty surface ID.\n")
+        sys.stderr.write("  It may not be running inside Ghostty.\n")
+        return 1
+
+    if focus_ghostty_surface(session["surface_id"]):
+        sys.stdout.write(f"  Focused: {session['project']}\n")
+        return 0
+    else:
+        sys.stderr.write(f"  Failed to focus surface for '{session['project']}'.\n")
+        return 1
+
+
+def resolve_socket_path(args=None):
+    """Return the daemon socket path: --socket, then AGENT_STATUS_SOCKET, then the default."""
+    if args is not None and args.socket:
+        return args.socket
+    return os.environ.get(SOCKET_ENV_VAR, DEFAULT_SOCKET_PATH)
+
+
+def format_daemon_snapshot(
+    sessions, seq, cpu_threshold, generated_at=None, subtree_cpu=False, subtree_io=False
+):
+    """Encode one daemon snapshot: a compact json-v2 envelope plus seq and classification."""
+    import json
+    payload = {
+        "schema_version": JSON_V2_SCHEMA_VERSION,
+        "generated_at": generated_at or current_utc_iso8601(),
+        "seq": seq,
+        "cpu_threshold": cpu_threshold,
+        "subtree_cpu": subtree_cpu,
+        "subtree_io": subtree_io,
+        "sessions": sessions,
+    }
+    return (json.dumps(payload, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class SnapshotDaemon:
+    """Runs the collection loop once and hands each snapshot to socket clients.
+
+    Snapshots are published under a Condition so that any number of
+    subscribers can wait for the next one without polling.
+    """
+
+    def __init__(self, cpu_threshold=DEFAULT_CPU_THRESHOLD, subtree_cpu=False, subtree_io=False):
+        self.cpu_threshold = cpu_threshold
+        self.subtree_cpu = subtree_cpu
+        self.subtree_io = subtree_io
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.snapshot = None
+        self.sessions = None
+        self.generated_at = None
+        self.stopped = False
+
+    def publish(self, sessions):
+        generated_at = current_utc_iso8601()
+        with self.condition:
+            self.seq += 1
+            self.sessions = sessions
+            self.generated_at = generated_at
+            self.snapshot = format_daemon_snapshot(
+                sessions,
+                self.seq,
+                self.cpu_threshold,
+                generated_at=generated_at,
+                subtree_cpu=self.subtree_cpu,
+                subtree_io=self.subtree_io,
+            )
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def wait_for(self, after_seq, timeout=None):
+        """Return (seq, snapshot) newer than after_seq, or None on timeout/stop."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.stopped or self.seq > after_seq, timeout=timeout
+            )
+            if self.stopped or self.seq <= after_seq:
+                return None
+            return (self.seq, self.snapshot)
+
+    def wait_for_sessions(self, after_seq, timeout=None):
+        """Like wait_for, but return (seq, sessions, generated_at) for delta encoding."""
+        with self.condition:
+            if self.wait_for(after_seq, timeout=timeout) is None:
+                return None
+            return (self.seq, self.sessions, self.generated_at)
+
+    def run(self, args, collector=None, exporter=None):
+        """Collect on the watch schedule until interrupted, publishing every cycle.
+
+        exporter (MetricsExporter), if given, observes every cycle too.
+        """
+        waiter = make_event_waiter() if args.events else SleepWaiter()
+        engine = AsyncEngine(args.concurrency)
+        ring = open_history(resolve_history_path()) if history_enabled(args) else None
+        try:
+            self._loop(args, collector, waiter, engine, ActivityHistory(ring), exporter)
+        finally:
+            waiter.close()
+            engine.close()
+            if ring is not None:
+                ring.close()
+
+    def _loop(self, args, collector, waiter, engine, history, exporter):
+        cache = {}
+        cpu_sampler = CpuSampler()
+        io_sampler = IoSampler() if self.subtree_io else None
+        registry = RegistryReader()
+        sessions = []
+        scheduled = time.monotonic()
+        while True:
+            auto_compact_registry(args)
+            deadline = Deadline(args.deadline or resolve_watch_interval(args, sessions))
+            profiler = CycleProfiler() if exporter is not None else None
+            timed_out = False
+            try:
+                sessions = collect_sessions(
+                    cache=cache,
+                    cpu_threshold=self.cpu_threshold,
+                    collector=collector,
+                    cpu_sampler=cpu_sampler,
+                    registry=registry,
+                    profiler=profiler,
+                    deadline=deadline,
+                    engine=engine,
+                    subtree_cpu=self.subtree_cpu,
+                    io_sampler=io_sampler,
+                )
+            except CollectionTimeout:
+                timed_out = True
+                sessions = mark_unresolved(sessions, ["cpu", "status"])
+            history.record(sessions)
+            self.publish(sessions)
+            if exporter is not None:
+                exporter.observe(
+                    sessions, timings=profiler.report(), timed_out=timed_out
+                )
+            scheduled = next_cycle_time(
+                scheduled, resolve_watch_interval(args, sessions), time.monotonic()
+            )
+            scheduled = wait_for_next_cycle(waiter, scheduled, sessions)
+
+
+@functools.lru_cache(maxsize=None)
+def daemon_request_handler_class():
+    """Return the handler shared by the Unix and TCP daemon servers."""
+    import json
+    import socketserver
+
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        """Answer one client request line: {"op": "snapshot" | "subscribe" | "deltas" | "ping"}.
+
+        Replies are JSON lines; a subscription gets every new snapshot until it
+        disconnects, and "deltas" gets DeltaStream events: one snapshot, then
+        only what changed.
+        """
+
+        def handle(self):
+            daemon = self.server.snapshots
+            try:
+                request = json.loads(self.rfile.readline(4096) or b"{}")
+            except ValueError:
+                request = {}
+            op = request.get("op") if isinstance(request, dict) else None
+            try:
+                if op == "snapshot":
+                    latest = daemon.wait_for(0)
+                    if latest is not None:
+                        self.wfile.write(latest[1])
+                elif op == "subscribe":
+                    seq = 0
+                    while True:
+                        latest = daemon.wait_for(seq)
+                        if latest is None:
+                            break
+                        seq, snapshot = latest
+                        self.wfile.write(snapshot)
+                        self.wfile.flush()
+                elif op == "deltas":
+                    stream = DeltaStream()
+                    seq = 0
+                    while True:
+                        latest = daemon.wait_for_sessions(seq)
+                        if latest is None:
+                            break
+                        seq, sessions, generated_at = latest
+                        events = stream.format(sessions, generated_at=generated_at)
+                        if events:
+                            self.wfile.write(events.encode("utf-8"))
+                            self.wfile.flush()
+                elif op == "ping":
+                    self.wfile.write(b'{"ok":true}\n')
+                else:
+                    self.wfile.write(b'{"error":"unknown op"}\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return DaemonRequestHandler
+
+
+@functools.lru_cache(maxsize=None)
+def daemon_server_class():
+    """Return the DaemonServer class, building it (and importing socketserver) on first use."""
+    import socketserver
+
+    class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path, snapshots):
+            self.snapshots = snapshots
+            # Create the socket owner-only; session data includes cwds and tasks
+            old_umask = os.umask(0o177)
+            try:
+                super().__init__(path, daemon_request_handler_class())
+            finally:
+                os.umask(old_umask)
+
+    return DaemonServer
+
+
+@functools.lru_cache(maxsize=None)
+def daemon_tcp_server_class():
+    """Return the DaemonTCPServer class (--listen), for aggregators on other hosts."""
+    import socketserver
+
+    class DaemonTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self, address, snapshots):
+            self.snapshots = snapshots
+            super().__init__(address, daemon_request_handler_class())
+
+    return DaemonTCPServer
+
+
+def request_daemon(socket_path, op, timeout=DAEMON_CONNECT_TIMEOUT):
+    """Connect to a daemon and send op. Returns a line reader, or None if none is running."""
+    if not os.path.exists(socket_path):
+        # The common case when no daemon runs; skips importing socket at all
+        return None
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"op": op}).encode("utf-8") + b"\n")
+    except OSError:
+        sock.close()
+        return None
+    reader = sock.makefile("rb")
+    sock.close()  # the file object keeps the connection open
+    return reader
+
+
+def fetch_daemon_snapshot(socket_path, timeout=DAEMON_CONNECT_TIMEOUT):
+    """Return the latest snapshot from a running daemon, or None if there is none."""
+    reader = request_daemon(socket_path, "snapshot", timeout=timeout)
+    if reader is None:
+        return None
+    import json
+    with reader:
+        try:
+            payload = json.loads(reader.readline())
+        except (OSError, ValueError):
+            return None
+    if not isinstance(payload, dict) or not isinstance(payload.get("sessions"), list):
+        return None
+    return payload
+
+
+def daemon_sessions(args, cpu_threshold):
+    """Return sessions from a running daemon, or None to collect directly.
+
+    The daemon is skipped with --no-daemon or --profile, and when it
+    classifies with a different CPU threshold or subtree setting than this
+    invocation asked for.
+    """
+    if args.no_daemon or args.profile:
+        return None
+    payload = fetch_daemon_snapshot(resolve_socket_path(args))
+    if payload is None or payload.get("cpu_threshold") != cpu_threshold:
+        return None
+    if bool(payload.get("subtree_cpu")) != args.subtree_cpu:
+        return None
+    if args.subtree_io and not payload.get("subtree_io"):
+        return None
+    return payload
+
+
+def serve_daemon(args, collector=None, cpu_threshold=DEFAULT_CPU_THRESHOLD):
+    """Run --serve until interrupted. Returns the process exit status."""
+    socket_path = resolve_socket_path(args)
+    reader = request_daemon(socket_path, "ping")
+    if reader is not None:
+        reader.close()
+        sys.stderr.write(f"  A daemon is already serving {socket_path}.\n")
+        return 1
+    # Nothing answered, so any socket file left behind is stale
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+
+    daemon = SnapshotDaemon(
+        cpu_threshold=cpu_threshold,
+        subtree_cpu=args.subtree_cpu,
+        subtree_io=subtree_io_enabled(args),
+    )
+    tcp_server = None
+    if args.listen:
+        host, port = args.listen
+        try:
+            tcp_server = daemon_tcp_server_class()(args.listen, daemon)
+        except OSError as exc:
+            sys.stderr.write(f"  Could not listen on {host}:{port}: {exc}\n")
+            return 1
+        threading.Thread(target=tcp_server.serve_forever, daemon=True).start()
+        sys.stderr.write(f"  Serving sessions on {host}:{tcp_server.server_address[1]}\n")
+    server = daemon_server_class()(socket_path, daemon)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    sys.stderr.write(f"  Serving sessions on {socket_path}\n")
+    exporter = None
+    try:
+        exporter = open_metrics_exporter(args)
+        daemon.run(args, collector=collector, exporter=exporter)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.close()
+        daemon.stop()
+        if tcp_server is not None:
+            tcp_server.shutdown()
+            tcp_server.server_close()
+        server.shutdown()
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+    return 0
+
+
+def parse_endpoint(raw):
+    """Parse an --aggregate endpoint: [NAME=]HOST:PORT, [NAME=]unix:PATH or [NAME=]exec:COMMAND.
+
+    A bare path is a Unix socket. exec runs COMMAND and follows its stdout,
+    which must be a --watch --json-diff stream (e.g. over ssh). Returns
+    {"name", "kind", "address"}; the name is the host column value.
+    """
+    name = None
+    spec = raw.strip()
+    head, sep, rest = spec.partition("=")
+    if sep and head and not any(char in head for char in ":/ "):
+        name, spec = head, rest.strip()
+    if spec.startswith("exec:"):
+        kind, address = "exec", spec[len("exec:"):].strip()
+        default_name = None
+        if not address or name is None:
+            raise ValueError(f"endpoint '{raw}' needs a NAME= prefix and a command")
+    elif spec.startswith("unix:") or spec.startswith(("/", "~", ".")):
+        kind = "unix"
+        address = os.path.expanduser(spec[len("unix:"):] if spec.startswith("unix:") else spec)
+        default_name = os.uname().nodename
+    else:
+        host, sep, port = spec.rpartition(":")
+        if not sep or not host or not port.isdigit():
+            raise ValueError(
+                f"invalid endpoint '{raw}'; use HOST:PORT, unix:PATH or exec:COMMAND"
+            )
+        kind, address = "tcp", (host.strip("[]"), int(port))
+        default_name = address[0]
+    return {"name": name or default_name, "kind": kind, "address": address}
+
+
+def parse_endpoints(raw_values):
+    """Parse repeated --aggregate values; host names must be unique. None stays None."""
+    if not raw_values:
+        return None
+    endpoints = [parse_endpoint(raw) for raw in raw_values]
+    names = [endpoint["name"] for endpoint in endpoints]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError(f"two --aggregate endpoints are named '{name}'; use NAME=ENDPOINT")
+    return endpoints
+
+
+def parse_listen_address(raw):
+    """Parse --listen HOST:PORT into a (host, port) address."""
+    if raw is None:
+        return None
+    host, sep, port = raw.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"invalid --listen address '{raw}'; use HOST:PORT")
+    return (host.strip("[]") or "127.0.0.1", int(port))
+
+
+class HostFeed:
+    """Follows one collector's DeltaStream events on a thread, mirroring its sessions.
+
+    Changes are made under the condition shared by all feeds of a
+    SessionAggregator, and bump version. A dropped connection clears the
+    host's sessions and is retried after an exponential backoff; a gap in
+    event seq reconnects, which starts over with a fresh snapshot.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        condition,
+        backoff=AGGREGATE_BACKOFF_INITIAL,
+        max_backoff=AGGREGATE_BACKOFF_MAX,
+        clock=time.monotonic,
+    ):
+        self.endpoint = endpoint
+        self.name = endpoint["name"]
+        self.condition = condition
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sessions = {}
+        self.received = {}
+        self.seq = 0
+        self.version = 0
+        self.connected = False
+        self.ready = False
+        self.error = None
+        self.failures = 0
+        self.retry_at = None
+        self.stopping = threading.Event()
+        self.closer = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        closer = self.closer
+        if closer is not None:
+            closer()
+
+    def open_stream(self):
+        """Connect and request deltas. Returns (line reader, closer); raises OSError."""
+        kind, address = self.endpoint["kind"], self.endpoint["address"]
+        if kind == "exec":
+            import shlex
+            import subprocess
+            proc = subprocess.Popen(
+                shlex.split(address),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+
+            def close_process():
+                with contextlib.suppress(OSError):
+                    proc.kill()
+                proc.wait()
+                proc.stdout.close()
+
+            return proc.stdout, close_process
+
+        import json
+        import socket
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(DAEMON_CONNECT_TIMEOUT)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(address, timeout=DAEMON_CONNECT_TIMEOUT)
+            # Deltas can be quiet for hours; let the kernel notice a vanished host
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            sock.sendall(json.dumps({"op": "deltas"}).encode("utf-8") + b"\n")
+            sock.settimeout(None)
+        except OSError:
+            sock.close()
+            raise
+        reader = sock.makefile("rb")
+
+        def close_socket():
+            # shutdown wakes a reader blocked in recv on another thread
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            reader.close()
+            sock.close()
+
+        return reader, close_socket
+
+    def run(self):
+        import json
+        while not self.stopping.is_set():
+            try:
+                reader, self.closer = self.open_stream()
+            except OSError as exc:
+                error = exc.strerror or str(exc)
+            else:
+                if self.stopping.is_set():
+                    self.closer()
+                    break
+                error = "connection closed"
+                try:
+                    for line in reader:
+                        self.apply(json.loads(line))
+                except (OSError, ValueError, KeyError, TypeError) as exc:
+                    error = str(exc) or error
+                finally:
+                    self.closer, closer = None, self.closer
+                    closer()
+            if self.stopping.is_set():
+                break
+            self.stopping.wait(self.disconnected(error))
+
+    def apply(self, event):
+        """Apply one DeltaStream event; raises ValueError on a seq gap."""
+        with self.condition:
+            kind = event.get("type")
+            now = self.clock()
+            if kind == "snapshot":
+                self.sessions = {s["pid"]: dict(s) for s in event["sessions"]}
+                self.received = {pid: now for pid in self.sessions}
+                self.connected = self.ready = True
+                self.failures = 0
+                self.error = None
+            elif event.get("seq") != self.seq + 1:
+                raise ValueError(f"missed events after seq {self.seq}")
+            elif kind == "added":
+                self.sessions[event["pid"]] = dict(event["session"])
+                self.received[event["pid"]] = now
+            elif kind == "removed":
+                self.sessions.pop(event["pid"], None)
+                self.received.pop(event["pid"], None)
+            elif kind == "changed" and event["pid"] in self.sessions:
+                session = self.sessions[event["pid"]]
+                for key, value in event["fields"].items():
+                    if value is None and key == "unresolved":
+                        session.pop(key, None)
+                    else:
+                        session[key] = value
+            self.seq = event.get("seq", self.seq)
+            self.version += 1
+            self.condition.notify_all()
+
+    def disconnected(self, error):
+        """Drop the host's sessions after a failure; returns the delay before retrying."""
+        with self.condition:
+            self.failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            self.sessions = {}
+            self.received = {}
+            self.seq = 0
+            self.connected = False
+            self.ready = True
+            self.error = error
+            self.retry_at = self.clock() + delay
+            self.version += 1
+            self.condition.notify_all()
+        return delay
+
+    def current_sessions(self):
+        """Return this host's sessions with a host field and uptimes brought up to date.
+
+        Callers hold the condition. Delta streams leave uptime out of
+        "changed" events, so it is advanced here from when each was received.
+        """
+        now = self.clock()
+        rows = []
+        for pid, session in self.sessions.items():
+            row = dict(session, host=self.name)
+            if session.get("uptime_seconds") is not None:
+                seconds = int(session["uptime_seconds"] + now - self.received[pid])
+                row["uptime_seconds"] = seconds
+                row["uptime"] = format_duration(seconds)
+            rows.append(row)
+        return rows
+
+
+class SessionAggregator:
+    """Merges the sessions of several collectors, one HostFeed each, into one list."""
+
+    def __init__(self, endpoints, feed_class=HostFeed):
+        self.condition = threading.Condition()
+        self.feeds = [feed_class(endpoint, self.condition) for endpoint in endpoints]
+
+    def start(self):
+        for feed in self.feeds:
+            feed.start()
+
+    def close(self):
+        for feed in self.feeds:
+            feed.stop()
+
+    def version(self):
+        return sum(feed.version for feed in self.feeds)
+
+    def wait_ready(self, timeout=AGGREGATE_READY_TIMEOUT):
+        """Wait until every feed has a first snapshot or a first failure."""
+        with self.condition:
+            self.condition.wait_for(lambda: all(f.ready for f in self.feeds), timeout=timeout)
+
+    def wait(self, seen_version, timeout=None):
+        """Wait for any feed to change after seen_version; returns the current version."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version() != seen_version, timeout=timeout)
+            return self.version()
+
+    def sessions(self):
+        """Return every host's sessions: active first, then by host and project."""
+        with self.condition:
+            merged = [row for feed in self.feeds for row in feed.current_sessions()]
+        status_order = {"active": 0, "idle": 1, "stopped": 2}
+        merged.sort(key=lambda s: (
+            status_order.get(s.get("status"), 9), s["host"], s.get("project") or "", s["pid"]
+        ))
+        return merged
+
+    def format_hosts(self):
+        """Return a table footer naming hosts that are not connected ("" if none)."""
+        lines = []
+        with self.condition:
+            now = None
+            for feed in self.feeds:
+                if feed.connected:
+                    continue
+                if not feed.ready:
+                    lines.append(f"  {feed.name}: connecting")
+                    continue
+                now = feed.clock() if now is None else now
+                retry = max(0, int(round(feed.retry_at - now)))
+                lines.append(f"  {feed.name}: {feed.error}; retrying in {retry}s")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def format_aggregated(args, aggregator, delta_stream):
+    """Render the merged sessions in the output mode args asks for."""
+    sessions = aggregator.sessions()
+    if args.fields is not None:
+        sessions = project_sessions(sessions, ("host",) + args.fields)
+    if args.json_diff:
+        return delta_stream.format(sessions)
+    if args.json_v2:
+        return format_json_v2(sessions)
+    if args.json_output:
+        return format_json(sessions)
+    table = format_table(sessions, show_task=not args.no_task, task_width=args.task_width)
+    hosts = aggregator.format_hosts()
+    return table + ("\n" + hosts if hosts else "")
+
+
+def run_aggregator(args):
+    """Run --aggregate: print the merged sessions once, or keep redrawing with --watch."""
+    aggregator = SessionAggregator(args.aggregate)
+    delta_stream = DeltaStream(key_fields=("host", "pid"))
+    aggregator.start()
+    try:
+        aggregator.wait_ready()
+        if not args.watch:
+            sys.stdout.write(format_aggregated(args, aggregator, delta_stream))
+            return 0
+        renderer = TerminalRenderer()
+        seen = aggregator.version()
+        while True:
+            output = format_aggregated(args, aggregator, delta_stream)
+            if args.json_output or args.json_v2 or args.json_diff:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+            else:
+                renderer.render(output)
+            # Redraw on any host's change, and every interval for uptimes and retries
+            seen = aggregator.wait(seen, timeout=args.interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        aggregator.close()
+
+
+def format_metric_labels(labels):
+    """Render {name: value} as a Prometheus label set, escaping values."""
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        text = "" if value is None else str(value)
+        text = text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{name}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_metric_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class SessionMetrics:
+    """Prometheus metrics fed by the --watch/--serve loop, rendered on scrape.
+
+    observe() runs once per collection cycle on the loop's own results, so
+    a scrape only formats what is already here and never collects.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.previous_statuses = {}
+        self.transitions = {pair: 0 for pair in ALL_TRANSITIONS}
+        self.latency = {}
+        self.cycles = 0
+        self.timeouts = 0
+        self.subprocesses = 0
+        self.last_cycle = None
+
+    def observe(self, sessions, timings=None, timed_out=False):
+        """Record one cycle: its sessions, stage timings and whether the scan timed out."""
+        with self.lock:
+            self.cycles += 1
+            self.last_cycle = self.clock()
+            if timed_out:
+                self.timeouts += 1
+            else:
+                for transition in detect_transitions(
+                    self.previous_statuses, sessions, ALL_TRANSITIONS
+                ):
+                    self.transitions[(transition["from"], transition["to"])] += 1
+                self.previous_statuses = {s["pid"]: s["status"] for s in sessions}
+                self.sessions = sessions
+            if timings:
+                self.subprocesses += timings["subprocesses"]
+                stages = dict(timings["stages"], total={"ms": timings["total_ms"]})
+                for name, stage in stages.items():
+                    self._observe_latency(name, stage["ms"] / 1000)
+
+    def _observe_latency(self, stage, seconds):
+        histogram = self.latency.setdefault(
+            stage, {"buckets": [0] * len(METRICS_LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+        )
+        for index, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(
+                    f"{name}{suffix}{format_metric_labels(labels)} {format_metric_value(value)}"
+                )
+
+        with self.lock:
+            groups = {}
+            for session in self.sessions:
+                key = (session.get("status"), session.get("project"), session.get("branch"))
+                groups[key] = groups.get(key, 0) + 1
+            metric(
+                "agent_status_sessions", "gauge",
+                "Sessions by status, project and branch.",
+                [
+                    ("", {"status": status, "project": project, "branch": branch or ""}, count)
+                    for (status, project, branch), count in sorted(
+                        groups.items(), key=lambda item: tuple(str(v) for v in item[0])
+                    )
+                ],
+            )
+            metric(
+                "agent_status_session_cpu_percent", "gauge",
+                "CPU usage of each session over the last cycle.",
+                [
+                    ("", {"pid": s["pid"], "project": s.get("project")}, s.get("cpu") or 0.0)
+                    for s in self.sessions
+                ],
+            )
+            metric(
+                "agent_status_transitions_total", "counter",
+                "Session status transitions seen between cycles.",
+                [
+                    ("", {"from": before, "to": after}, count)
+                    for (before, after), count in self.transitions.items()
+                ],
+            )
+            samples = []
+            for stage in sorted(self.latency):
+                histogram = self.latency[stage]
+                for bound, count in zip(METRICS_LATENCY_BUCKETS, histogram["buckets"]):
+                    labels = {"stage": stage, "le": format_metric_value(bound)}
+                    samples.append(("_bucket", labels, count))
+                samples.append(("_bucket", {"stage": stage, "le": "+Inf"}, histogram["count"]))
+                samples.append(("_sum", {"stage": stage}, round(histogram["sum"], 6)))
+                samples.append(("_count", {"stage": stage}, histogram["count"]))
+            metric(
+                "agent_status_collect_stage_seconds", "histogram",
+                "Wall time of each collect_sessions stage; stage=\"total\" is the whole cycle.",
+                samples,
+            )
+            metric(
+                "agent_status_collect_cycles_total", "counter",
+                "Collection cycles run.", [("", {}, self.cycles)],
+            )
+            metric(
+                "agent_status_collect_timeouts_total", "counter",
+                "Cycles whose process table read missed the deadline.",
+                [("", {}, self.timeouts)],
+            )
+            metric(
+                "agent_status_subprocesses_total", "counter",
+                "Subprocesses spawned by collection.", [("", {}, self.subprocesses)],
+            )
+            if self.last_cycle is not None:
+                metric(
+                    "agent_status_last_cycle_timestamp_seconds", "gauge",
+                    "Unix time the last collection cycle finished.",
+                    [("", {}, round(self.last_cycle, 3))],
+                )
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=None)
+def metrics_server_class():
+    """Return the MetricsServer class, building it (and importing http.server) on first use."""
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = self.server.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class MetricsServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+
+        def __init__(self, address, metrics):
+            self.metrics = metrics
+            super().__init__(address, MetricsRequestHandler)
+
+    return MetricsServer
+
+
+def write_metrics_textfile(path, metrics):
+    """Atomically replace path with the rendered metrics (node_exporter textfile collector)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            handle.write(metrics.render())
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        sys.stderr.write(f"  Could not write metrics to {path}: {exc}\n")
+
+
+class MetricsExporter:
+    """Feeds SessionMetrics each cycle and publishes it over HTTP and/or a textfile."""
+
+    def __init__(self, metrics, server=None, textfile=None):
+        self.metrics = metrics
+        self.server = server
+        self.textfile = textfile
+        if server is not None:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def observe(self, sessions, timings=None, timed_out=False):
+        self.metrics.observe(sessions, timings=timings, timed_out=timed_out)
+        if self.textfile:
+            write_metrics_textfile(self.textfile, self.metrics)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def open_metrics_exporter(args):
+    """Return a MetricsExporter for --metrics-port/--metrics-textfile, or None."""
+    if args.metrics_port is None and not args.metrics_textfile:
+        return None
+    metrics = SessionMetrics()
+    server = None
+    if args.metrics_port is not None:
+        try:
+            server = metrics_server_class()((args.metrics_host, args.metrics_port), metrics)
+        except OSError as exc:
+            sys.stderr.write(
+                f"  Could not listen on {args.metrics_host}:{args.metrics_port}: {exc}\n"
+            )
+            sys.exit(1)
+        sys.stderr.write(
+            f"  Serving metrics on http://{args.metrics_host}:{server.server_address[1]}/metrics\n"
+        )
+    return MetricsExporter(metrics, server=server, textfile=args.metrics_textfile)
+
+
+def main():
+    args = parse_args()
+    cpu_threshold = resolve_cpu_threshold(args)
+    show_task = not args.no_task
+    task_width = args.task_width
+    collect_fields, output_fields = resolve_fields(args)
+    registry_path = args.registry_path or resolve_registry_path()
+    collector = default_collector(args.collector)
+
+    if args.registry_compact:
+        kept, removed, existed = compact_registry(
+            registry_path, keep=args.registry_keep, prune_dead=args.registry_prune_dead
+        )
+        if not existed:
+            sys.stderr.write(f"  Registry not found: {registry_path}\n")
+            sys.exit(1)
+        sys.stdout.write(
+            f"  Compacted registry: kept {kept} entries, removed {removed}.\n"
+        )
+        sys.exit(0)
+
+    if args.history:
+        sys.exit(show_history(resolve_history_path()))
+
+    auto_compact_registry(args)
+
+    if args.serve:
+        sys.exit(serve_daemon(args, collector=collector, cpu_threshold=cpu_threshold))
+
+    if args.aggregate:
+        sys.exit(run_aggregator(args))
+
+    if args.goto:
+        payload = daemon_sessions(args, cpu_threshold)
+        try:
+            with persistent_cache(None if payload else resolve_cache_path(args, collector)) as cache:
+                status = handle_goto(
+                    args.goto,
+                    collector=collector,
+                    deadline=Deadline(args.deadline or DEFAULT_CYCLE_BUDGET),
+                    sessions=payload["sessions"] if payload else None,
+                    cache=cache,
+                )
+        except CollectionTimeout as exc:
+            sys.stderr.write(f"  {exc}\n")
+            status = 1
+        sys.exit(status)
+
+    if not args.watch:
+        payload = daemon_sessions(args, cpu_threshold)
+        if payload is not None:
+            sessions = project_sessions(payload["sessions"], output_fields)
+            if args.json_diff:
+                sys.stdout.write(
+                    DeltaStream().format(sessions, generated_at=payload["generated_at"])
+                )
+            elif args.json_v2:
+                sys.stdout.write(format_json_v2(sessions, generated_at=payload["generated_at"]))
+            elif args.json_output:
+                sys.stdout.write(format_json(sessions))
+            else:
+                history = table_history(args)
+                sys.stdout.write(
+                    format_table(
+                        sessions,
+                        show_task=show_task,
+                        task_width=task_width,
+                        history=history.annotations(sessions) if history else None,
+                        show_sparkline=args.sparkline,
+                    )
+                )
+            return
+
+    if args.watch:
+        exporter = open_metrics_exporter(args)
+        cache = {}
+        cpu_sampler = CpuSampler()
+        io_sampler = IoSampler() if subtree_io_enabled(args) else None
+        registry = RegistryReader()
+        previous_statuses = {}
+        last_alerts = {}
+        alert_on = args.alert_on
+        dispatcher = None
+        if args.alert:
+            dispatcher = NotificationDispatcher(
+                build_notification_backends(args), coalesce_seconds=args.alert_coalesce
+            )
+        sessions = []
+        scheduled = time.monotonic()
+        waiter = make_event_waiter() if args.events else SleepWaiter()
+        renderer = TerminalRenderer()
+        delta_stream = DeltaStream()
+        engine = AsyncEngine(args.concurrency)
+        # Without a history file, idle durations still count from this watch's start
+        ring = open_history(resolve_history_path()) if history_enabled(args) else None
+        history = ActivityHistory(ring)
+        try:
+            while True:
+                auto_compact_registry(args)
+                profiler = CycleProfiler() if args.profile or exporter is not None else None
+                # A cycle may use the whole interval, but no more, unless --deadline says otherwise
+                deadline = Deadline(args.deadline or resolve_watch_interval(args, sessions))
+                timed_out = False
+                try:
+                    sessions = collect_sessions(
+                        cache=cache,
+                        cpu_threshold=cpu_threshold,
+                        collector=collector,
+                        cpu_sampler=cpu_sampler,
+                        registry=registry,
+                        profiler=profiler,
+                        deadline=deadline,
+                        engine=engine,
+                        fields=collect_fields,
+                        subtree_cpu=args.subtree_cpu,
+                        io_sampler=io_sampler,
+                    )
+                except CollectionTimeout:
+                    # Keep showing the last sessions until the process table answers again
+                    timed_out = True
+                    sessions = mark_unresolved(sessions, ["cpu", "status"])
+                report = profiler.report() if profiler else None
+                timings = report if args.profile else None
+                if exporter is not None:
+                    exporter.observe(sessions, timings=report, timed_out=timed_out)
+
+                transitioned_pids = set()
+                if args.alert and previous_statuses and not timed_out:
+                    transitions = detect_transitions(previous_statuses, sessions, alert_on)
+                    transitioned_pids = {
+                        t["pid"]
+                        for t in transitions
+                        if t["from"] == "active" and t["to"] == "idle"
+                    }
+                    alert_transitions(
+                        sessions,
+                        transitions,
+                        cooldown_seconds=args.alert_cooldown,
+                        last_alerts=last_alerts,
+                        dispatcher=dispatcher,
+                    )
+
+                if not timed_out:
+                    previous_statuses = {s["pid"]: s["status"] for s in sessions}
+                    history.record(sessions)
+
+                if args.json_diff:
+                    shown = project_sessions(sessions, output_fields)
+                    sys.stdout.write(delta_stream.format(shown))
+                    # Consumers tail this stream, so do not let events sit in a pipe buffer
+                    sys.stdout.flush()
+                    if timings:
+                        sys.stderr.write(format_timings(timings) + "\n")
+                elif args.json_v2:
+                    sys.stdout.write(
+                        format_json_v2(project_sessions(sessions, output_fields), timings=timings)
+                    )
+                elif args.json_output:
+                    sys.stdout.write(format_json(project_sessions(sessions, output_fields)))
+                    if timings:
+                        sys.stderr.write(format_timings(timings) + "\n")
+                else:
+                    renderer.render(
+                        format_table(
+                            sessions,
+                            transitioned_pids=transitioned_pids,
+                            show_task=show_task,
+                            task_width=task_width,
+                            timings=timings,
+                            history=history.annotations(sessions),
+                            show_sparkline=args.sparkline,
+                        )
+                    )
+                scheduled = next_cycle_time(
+                    scheduled, resolve_watch_interval(args, sessions), time.monotonic()
+                )
+                scheduled = wait_for_next_cycle(waiter, scheduled, sessions)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            waiter.close()
+            engine.close()
+            if ring is not None:
+                ring.close()
+            if exporter is not None:
+                exporter.close()
+            if dispatcher is not None:
+                dispatcher.close()
+    else:
+        deadline = Deadline(args.deadline or DEFAULT_CYCLE_BUDGET)
+        try:
+            with persistent_cache(resolve_cache_path(args, collector)) as cache:
+                if args.json_v2 or args.json_diff:
+                    profiler = CycleProfiler() if args.profile else None
+                    sessions = collect_sessions(
+                        cache=cache,
+                        cpu_threshold=cpu_threshold,
+                        collector=collector,
+                        profiler=profiler,
+                        deadline=deadline,
+                        fields=collect_fields,
+                        subtree_cpu=args.subtree_cpu,
+                    )
+                    sessions = project_sessions(sessions, output_fields)
+                    timings = profiler.report() if profiler else None
+                    if args.json_diff:
+                        sys.stdout.write(DeltaStream().format(sessions))
+                        if timings:
+                            sys.stderr.write(format_timings(timings) + "\n")
+                    else:
+                        sys.stdout.write(format_json_v2(sessions, timings=timings))
+                else:
+                    print_snapshot(
+                        json_output=args.json_output,
+                        cache=cache,
+                        cpu_threshold=cpu_threshold,
+                        show_task=show_task,
+                        task_width=task_width,
+                        collector=collector,
+                        profile=args.profile,
+                        deadline=deadline,
+                        fields=collect_fields,
+                        history=table_history(args),
+                        show_sparkline=args.sparkline,
+                        subtree_cpu=args.subtree_cpu,
+                        output_fields=output_fields,
+                    )
+        except CollectionTimeout as exc:
+            sys.stderr.write(f"  {exc}\n")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
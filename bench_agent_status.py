@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Benchmark agent-status collection stages against synthetic process tables.
+
+subprocess.run is replaced with canned ps/lsof/git output, so the numbers
+measure agent-status's own parsing and bookkeeping, and the subprocess
+counts show how many forks each stage would cost on a real machine.
+
+    python3 bench_agent_status.py                          # 100, 1k and 10k processes
+    python3 bench_agent_status.py --sizes 100 1000 --sessions 40 --depth 12
+    python3 bench_agent_status.py --save baseline.json
+    python3 bench_agent_status.py --compare baseline.json  # exit 1 on regression
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import agent_status as cs
+
+
+DEFAULT_SIZES = [100, 1000, 10000]
+STAGES = [
+    "discovery",
+    "get_process_info",
+    "dedupe_nested_pids",
+    "get_cwds",
+    "surface_ids",
+    "branch_lookup",
+    "load_registrations",
+    "collect_sessions",
+    "collect_sessions_warm",
+    "format_table",
+]
+ENV_PADDING = " ".join(f"VAR_{i}=value-{i}-padding-padding" for i in range(60))
+
+
+class SyntheticSystem:
+    """A fake machine: process table, working directories, repos and registry.
+
+    Each session sits at the bottom of a `depth`-long chain of ancestors
+    (login, shells, tmux, ...) and has a nested claude child plus tool
+    processes below it. Remaining slots are filler processes.
+    """
+
+    def __init__(self, root, size, sessions, depth, repos=8, registry_lines=2000):
+        self.root = root
+        self.rows = {}
+        self.cwds = {}
+        self.session_pids = []
+        self.spawned = {}
+        next_pid = [2]
+
+        def add(ppid, comm, tty="??", cpu=0.0):
+            pid = next_pid[0]
+            next_pid[0] += 1
+            self.rows[pid] = (ppid, cpu, "S", tty, comm)
+            return pid
+
+        self.rows[1] = (0, 0.0, "Ss", "??", "launchd")
+        repo_dirs = []
+        for index in range(repos):
+            repo = os.path.join(root, f"repo{index}")
+            os.makedirs(os.path.join(repo, ".git"))
+            with open(os.path.join(repo, ".git", "HEAD"), "w") as handle:
+                handle.write(f"ref: refs/heads/branch-{index}\n")
+            repo_dirs.append(repo)
+
+        for index in range(sessions):
+            if len(self.rows) + depth + 4 > size:
+                break
+            tty = f"ttys{index:03d}"
+            parent = 1
+            for level in range(depth):
+                parent = add(parent, "zsh" if level % 2 else "login", tty=tty)
+            pid = add(parent, "claude", tty=tty, cpu=12.5 if index % 3 == 0 else 0.4)
+            nested = add(pid, "claude", tty=tty)
+            add(nested, "node", tty=tty)
+            add(pid, "npm", tty=tty)
+            self.session_pids.append(pid)
+            cwd = repo_dirs[index % repos]
+            self.cwds[pid] = cwd
+            self.cwds[nested] = cwd
+
+        filler_parents = [1]
+        while len(self.rows) < size:
+            parent = filler_parents[len(self.rows) % len(filler_parents)]
+            filler_parents.append(add(parent, "helper"))
+
+        self.registry_path = os.path.join(root, "registrations.jsonl")
+        with open(self.registry_path, "w") as handle:
+            for line in range(registry_lines):
+                pid = self.session_pids[line % len(self.session_pids)] if self.session_pids else line
+                record = {"pid": pid + (line // 50) * 100000, "task": f"task {line}"}
+                handle.write(json.dumps(record) + "\n")
+
+    @property
+    def spawn_count(self):
+        return sum(self.spawned.values())
+
+    def ps_table(self):
+        lines = []
+        for pid, (ppid, cpu, state, tty, comm) in self.rows.items():
+            lines.append(f"{pid:>6} {ppid:>6} {cpu:5.1f} {state:<4} {tty:<8} 01:02:03  0:12.34 Sat Oct 17 09:00:00 2026 {comm}")
+        return "\n".join(lines) + "\n"
+
+    def lsof(self, pid_str):
+        out = []
+        for pid in (int(p) for p in pid_str.split(",")):
+            if pid in self.cwds:
+                out.append(f"p{pid}\nfcwd\nn{self.cwds[pid]}")
+        return "\n".join(out) + "\n"
+
+    def run(self, argv, **_kwargs):
+        """Stand-in for subprocess.run that answers from the synthetic tables."""
+        name = argv[0]
+        self.spawned[name] = self.spawned.get(name, 0) + 1
+        stdout = ""
+        if name == "ps" and "-ax" in argv:
+            stdout = self.ps_table()
+        elif name == "ps" and "-wwwE" in argv:
+            pid = int(argv[2])
+            stdout = (
+                f"  PID TTY      TIME CMD\n{pid} ttys000 0:00.10 claude "
+                f"TERM=xterm-ghostty {ENV_PADDING} GHOSTTY_SURFACE_ID=surface-{pid:08d}\n"
+            )
+        elif name == "lsof":
+            stdout = self.lsof(argv[3])
+        elif name == "git":
+            stdout = "main\n"
+        else:
+            return subprocess.CompletedProcess(argv, 1, "", "")
+        return subprocess.CompletedProcess(argv, 0, stdout, "")
+
+
+def time_stage(system, repeat, func):
+    """Run func repeat times; return (best ms, subprocesses per run, last value)."""
+    best = None
+    spawned = 0
+    value = None
+    for _ in range(repeat):
+        before = system.spawn_count
+        start = time.perf_counter()
+        value = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        spawned = system.spawn_count - before
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 3), spawned, value
+
+
+def run_benchmark(size, sessions=20, depth=6, repeat=3):
+    """Benchmark every stage for one synthetic table size. Returns {stage: result}."""
+    with tempfile.TemporaryDirectory() as root:
+        system = SyntheticSystem(root, size, sessions, depth)
+        collector = cs.PsCollector()
+        results = {}
+
+        def stage(name, func):
+            ms, spawned, value = time_stage(system, repeat, func)
+            results[name] = {"ms": ms, "subprocesses": spawned}
+            return value
+
+        def branches(cwds):
+            cs.GIT_BRANCH_CACHE.clear()
+            return {cwd: cs.get_git_branch(cwd) for cwd in set(cwds.values())}
+
+        env = {cs.REGISTRY_ENV_VAR: system.registry_path}
+        # Model a machine without /proc, where surface IDs cost ps probes
+        no_proc = os.path.join(root, "no-proc")
+        with patch("subprocess.run", side_effect=system.run), patch.dict(os.environ, env), \
+                patch.object(cs, "PROC_ROOT", no_proc):
+            table = stage("discovery", collector.scan)
+            pids = table.session_pids()
+            info = stage("get_process_info", lambda: table.process_info(pids))
+            valid = [pid for pid in pids if info[pid]["tty"] not in cs.NO_TTY_VALUES]
+            deduped = stage(
+                "dedupe_nested_pids",
+                lambda: cs.dedupe_nested_pids(valid, table.parent_map()),
+            )
+            cwds = stage("get_cwds", lambda: collector.cwds(deduped))
+            stage("surface_ids", lambda: {pid: collector.surface_id(pid) for pid in deduped})
+            stage("branch_lookup", lambda: branches(cwds))
+            stage(
+                "load_registrations",
+                lambda: cs.load_registrations(deduped, registry_path=system.registry_path),
+            )
+
+            def cold_cycle():
+                cs.GIT_BRANCH_CACHE.clear()
+                return cs.collect_sessions(collector=collector)
+
+            sessions_out = stage("collect_sessions", cold_cycle)
+
+            cache = {}
+            sampler = cs.CpuSampler()
+            registry = cs.RegistryReader(system.registry_path)
+            cs.collect_sessions(
+                cache=cache, collector=collector, cpu_sampler=sampler, registry=registry
+            )
+            stage(
+                "collect_sessions_warm",
+                lambda: cs.collect_sessions(
+                    cache=cache, collector=collector, cpu_sampler=sampler, registry=registry
+                ),
+            )
+            with patch.object(cs, "supports_color", return_value=False):
+                stage("format_table", lambda: cs.format_table(sessions_out))
+
+        results["_meta"] = {
+            "processes": len(system.rows),
+            "sessions": len(system.session_pids),
+            "depth": depth,
+        }
+        return results
+
+
+def format_report(report):
+    """Render {size: results} as a plain-text table."""
+    sizes = sorted(report, key=int)
+    header = f"  {'stage':<24}" + "".join(f"{size + ' procs':>22}" for size in sizes)
+    lines = [header]
+    for stage_name in STAGES:
+        row = f"  {stage_name:<24}"
+        for size in sizes:
+            result = report[size][stage_name]
+            cell = f"{result['ms']:.2f}ms/{result['subprocesses']}sp"
+            row += f"{cell:>22}"
+        lines.append(row)
+    return "\n".join(lines) + "\n"
+
+
+def compare_reports(baseline, current, tolerance):
+    """Return a list of regression messages between two reports."""
+    problems = []
+    for size, stages in current.items():
+        for stage_name, result in stages.items():
+            if stage_name.startswith("_"):
+                continue
+            before = baseline.get(size, {}).get(stage_name)
+            if before is None:
+                continue
+            if result["subprocesses"] > before["subprocesses"]:
+                problems.append(
+                    f"{size} procs {stage_name}: subprocesses "
+                    f"{before['subprocesses']} -> {result['subprocesses']}"
+                )
+            # Ignore sub-millisecond noise when comparing times
+            if result["ms"] > max(before["ms"] * tolerance, before["ms"] + 1.0):
+                problems.append(
+                    f"{size} procs {stage_name}: {before['ms']:.2f}ms -> {result['ms']:.2f}ms"
+                )
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark agent-status collection stages")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=list(DEFAULT_SIZES),
+        metavar="N",
+        help="process table sizes (default: 100 1000 10000)",
+    )
+    parser.add_argument("--sessions", type=int, default=20, help="agent sessions per table")
+    parser.add_argument("--depth", type=int, default=6, help="ancestor chain depth per session")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; best is kept")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--save", metavar="PATH", help="write results JSON to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="fail if slower than baseline PATH")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5,
+        help="allowed slowdown factor for --compare (default: 1.5)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        str(size): run_benchmark(size, args.sessions, args.depth, args.repeat)
+        for size in args.sizes
+    }
+
+    if args.json:
+        sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    else:
+        sys.stdout.write(format_report(report))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        problems = compare_reports(baseline, report, args.tolerance)
+        for problem in problems:
+            sys.stderr.write(f"  regression: {problem}\n")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())